@@ -17,11 +17,17 @@
 # <http://www.gnu.org/licenses/>.
 
 import sys
+import os
 import socket
 import collections
 import threading
 import functools
 import argparse
+import struct
+import mmap
+# Socket helpers are shared with hp_disk
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)) , "hp_disk"))
+import rem488
 
 debug_print = None
 
@@ -30,16 +36,37 @@ class ConnectionClosed(Exception):
 
 MSGS = "DEJKQRSXY"
 
+# Length of TCP Fast Open queue in server mode
+TFO_QUEUE_LEN = 5
+# Size of blocks written when formatting
+FILL_CHUNK = 1 << 20
+# Positioned I/O (pread/pwrite) is not available everywhere (e.g. Windows)
+HAS_PIO = hasattr(os , "pread") and hasattr(os , "pwrite")
+
 class Remote488MsgIO:
+    def _flush_batch(self, batch):
+        # Runs of consecutive D messages are queued as a single D_BATCH message
+        if len(batch) == 1:
+            self.q.append(('D' , batch[ 0 ]))
+        else:
+            self.q.append(('D_BATCH' , bytes(batch)))
+        with self.cv:
+            self.cv.notify()
+
     def my_th(self):
         state = 0
+        batch = bytearray()
+        quickack = rem488.TCP_QUICKACK is not None
         while True:
             try:
-                ins = self.sock.recv(4096)
+                n = self.sock.recv_into(self.rx_buf)
             except ConnectionError:
                 break
-            if not ins:
+            if not n:
                 break
+            ins = self.rx_mv[ :n ]
+            if quickack and n < len(self.rx_buf):
+                quickack = rem488.rearm_quickack(self.sock)
             for b in ins:
                 c = chr(b)
                 if state == 0:
@@ -68,6 +95,12 @@ class Remote488MsgIO:
                 elif state == 4:
                     if c.isspace() or c == ',' or c == ';':
                         state = 0
+                        if msg_type == 'D':
+                            batch.append(data)
+                            continue
+                        if batch:
+                            self._flush_batch(batch)
+                            batch.clear()
                         if msg_type == 'J':
                             with self.lock:
                                 self.sock.sendall(b'K:00\n')
@@ -80,12 +113,18 @@ class Remote488MsgIO:
                 else:
                     if c.isspace()  or c == ',' or c == ';':
                         state = 0
+            if batch:
+                self._flush_batch(batch)
+                batch.clear()
         self.q.append(ConnectionClosed())
         with self.cv:
             self.cv.notify()
 
     def __init__(self , sock):
         self.sock = sock
+        # Receive buffer, reused by every recv_into
+        self.rx_buf = bytearray(65536)
+        self.rx_mv = memoryview(self.rx_buf)
         self.cv = threading.Condition()
         self.lock = threading.RLock()
         self.q = collections.deque()
@@ -107,17 +146,27 @@ class Remote488MsgIO:
         with self.lock:
             self.sock.sendall(b)
 
-    def send_data(self, data , eoi_at_end = False):
+    def encode_data(self, data , eoi_at_end = False):
         last_dab = len(data)
         add_eoi = eoi_at_end and last_dab > 0
         if add_eoi:
             last_dab -= 1
+        s = "".join("D:{:02x},".format(b) for b in data[ :last_dab ])
+        if add_eoi:
+            s += "E:{:02x},".format(data[ last_dab ])
+        return bytes(s , encoding = "ascii")
+
+    def send_data(self, data , eoi_at_end = False):
+        b = self.encode_data(data , eoi_at_end)
         with self.lock:
             #print("T {}".format(data))
-            for b in data[ :last_dab ]:
-                self.send_msg('D' , b)
-            if add_eoi:
-                self.send_msg('E' , data[ last_dab ])
+            self.sock.sendall(b)
+
+    def send_data_with_checkpoint(self, data , eoi_at_end = False):
+        # Data and the trailing checkpoint go out in a single sendall
+        b = self.encode_data(data , eoi_at_end) + b"X:00,"
+        with self.lock:
+            self.sock.sendall(b)
 
     def send_pp_state(self, pp_state):
         self.send_msg('P' , pp_state)
@@ -200,13 +249,16 @@ class DeviceClear(BusCmd):
     def __str__(self):
         return "CLEAR"
 
+# Talk/listen commands
+TL_CMD_TYPES = (ListenCmd , TalkCmd)
+
 class UnknownModel(Exception):
     pass
 
 class CHSOutOfRange(Exception):
     def __init__(self, chs , max_chs):
         self.chs = chs
-        self.max_chs = chs
+        self.max_chs = max_chs
 
     def __str__(self ):
         return "({},{},{}) out of range, max = ({},{},{})".format(self.chs[ 0 ] , self.chs[ 1 ] , self.chs[ 2 ] , self.max_chs[ 0 ] - 1 ,  self.max_chs[ 1 ] - 1 ,  self.max_chs[ 2 ] - 1)
@@ -214,7 +266,7 @@ class CHSOutOfRange(Exception):
 class LBAOutOfRange(Exception):
     def __init__(self, lba , max_lba):
         self.lba = lba
-        self.max_lba = lba
+        self.max_lba = max_lba
 
     def __str__(self ):
         return "LBA {} out of range, max = {}".format(self.lba , self.max_lba)
@@ -238,19 +290,20 @@ class FixedDriveData:
         self.max_unit = rec[ 2 ]
         self.ignore_fmt = rec[ 3 ]
         self.max_lba = self.max_chs[ 0 ] * self.max_chs[ 1 ] * self.max_chs[ 2 ]
+        self.n_cyls , self.n_heads , self.n_secs = self.max_chs
+        self.secs_per_cyl = self.n_heads * self.n_secs
 
     def chs_to_lba(self, chs):
-        if chs[ 0 ] < 0 or chs[ 0 ] >= self.max_chs[ 0 ] or \
-           chs[ 1 ] < 0 or chs[ 1 ] >= self.max_chs[ 1 ] or \
-           chs[ 2 ] < 0 or chs[ 2 ] >= self.max_chs[ 2 ]:
+        c , h , s = chs
+        if not (0 <= c < self.n_cyls and 0 <= h < self.n_heads and 0 <= s < self.n_secs):
             raise CHSOutOfRange(chs , self.max_chs)
-        return (chs[ 0 ] * self.max_chs[ 1 ] + chs[ 1 ]) * self.max_chs[ 2 ] + chs[ 2 ]
+        return c * self.secs_per_cyl + h * self.n_secs + s
 
     def lba_to_chs(self, lba):
         if lba < 0 or lba > self.max_lba:
             raise LBAOutOfRange(lba , self.max_lba)
-        tmp , s = divmod(lba , self.max_chs[ 2 ])
-        c , h = divmod(tmp , self.max_chs[ 1 ])
+        c , tmp = divmod(lba , self.secs_per_cyl)
+        h , s = divmod(tmp , self.n_secs)
         return (c , h , s)
 
 class UnitState:
@@ -264,6 +317,18 @@ class UnitState:
         self.ss = 0
         self.tttt = 6
         self.image = image
+        # Sector I/O goes straight to the file descriptor (one pread/pwrite per sector)
+        # where positioned I/O is available, through seek & read/write otherwise
+        self.fd = image.fileno() if image else -1
+        # Sectors within the mapped part of image are accessed through memoryview slices
+        self.map = None
+        self.map_mv = None
+        if image:
+            try:
+                self.map = mmap.mmap(self.fd , 0)
+                self.map_mv = memoryview(self.map)
+            except (OSError , ValueError):
+                self.map = None
         if not self.is_ready():
             self.ss = 3
             self.f_bit = False
@@ -271,6 +336,19 @@ class UnitState:
     def is_ready(self ):
         return self.image != None
 
+    # Unload image: unmap it & close its file
+    def close(self ):
+        if self.map is not None:
+            self.map_mv.release()
+            self.map_mv = None
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        if self.image is not None:
+            self.image.close()
+            self.image = None
+            self.fd = -1
+
     def set_current_chs(self, chs):
         try:
             self.current_lba = self.fixed_data.chs_to_lba(chs)
@@ -285,28 +363,61 @@ class UnitState:
         return self.fixed_data.lba_to_chs(self.current_lba)
 
     def write_img(self, data):
-        if self.is_ready():
-            self.image.seek(256 * self.current_lba)
-            self.image.write(data)
-            self.current_lba += 1
-
-    def read_img(self ):
-        if self.is_ready():
-            self.image.seek(256 * self.current_lba)
-            data = bytearray(self.image.read(256))
+        if self.image is not None:
             if len(data) < 256:
-                data.extend(bytes(256 - len(data)))
-            self.current_lba += 1
+                # Pad short sectors with zeros
+                data = bytes(data) + bytes(256 - len(data))
+            lba = self.current_lba
+            pos = 256 * lba
+            map_mv = self.map_mv
+            if map_mv is not None and pos + 256 <= len(map_mv):
+                map_mv[ pos:pos + 256 ] = data
+            elif HAS_PIO:
+                os.pwrite(self.fd , data , pos)
+            else:
+                self.image.seek(pos)
+                self.image.write(data)
+            self.current_lba = lba + 1
+
+    # Copy current sector into "data" (a 256-byte bytearray)
+    def read_img(self, data):
+        if self.image is not None:
+            lba = self.current_lba
+            pos = 256 * lba
+            map_mv = self.map_mv
+            if map_mv is not None and pos + 256 <= len(map_mv):
+                data[ : ] = map_mv[ pos:pos + 256 ]
+            else:
+                if HAS_PIO:
+                    sector = os.pread(self.fd , 256 , pos)
+                else:
+                    self.image.seek(pos)
+                    sector = self.image.read(256)
+                n = len(sector)
+                data[ :n ] = sector
+                if n < 256:
+                    data[ n: ] = bytes(256 - n)
+            self.current_lba = lba + 1
         else:
-            data = bytearray(256)
-        return data
+            data[ : ] = bytes(256)
 
     def format_img(self, filler):
         if self.is_ready():
-            self.image.seek(0)
-            fill = bytes([ filler ] * 256)
-            for x in range(self.fixed_data.max_lba):
-                self.image.write(fill)
+            # Image is filled in blocks of up to FILL_CHUNK bytes
+            size = 256 * self.fixed_data.max_lba
+            fill = memoryview(bytes((filler ,)) * min(FILL_CHUNK , size))
+            if HAS_PIO:
+                fd = self.fd
+                pwrite = os.pwrite
+                pos = 0
+                while pos < size:
+                    pos += pwrite(fd , fill[ :size - pos ] , pos)
+            else:
+                self.image.seek(0)
+                pos = 0
+                while pos < size:
+                    pos += self.image.write(fill[ :size - pos ])
+                self.image.flush()
 
 class DriveState:
     def __init__(self , io , fixed_data , hpib_addr , images):
@@ -370,9 +481,6 @@ class DriveState:
     def send_end_byte(self):
         self.io.send_data(b"\x01" , True)
 
-    def send_checkpoint(self ):
-        self.io.send_msg('X' , 0)
-
     def set_seq_state(self, state):
         self.cmd_seq_state = state
 
@@ -432,14 +540,38 @@ class DriveState:
         mla = (self.hpib_addr & 0x1f) | 0x20
         msa = (self.hpib_addr & 0x1f) | 0x60
         dab_cnt = 0
+        # D messages split out of a D_BATCH that can't take the fast path
+        pending = collections.deque()
+        io = self.io
+        has_msg = io.has_msg
+        get_msg = io.get_msg
         while True:
-            with self.io.cv:
-                self.io.cv.wait_for(lambda : self.io.has_msg())
-            try:
-                m = self.io.get_msg()
-            except ConnectionClosed:
-                return
+            if pending:
+                m = pending.popleft()
+            else:
+                # Only go through the condition variable when the queue is empty
+                if not has_msg():
+                    with io.cv:
+                        io.cv.wait_for(has_msg)
+                try:
+                    m = get_msg()
+                except ConnectionClosed:
+                    return
             msg_type , msg_data = m
+            if msg_type == 'D_BATCH':
+                if state == 2 and listener and (signals & 1) != 0 and not debug_print:
+                    # Fast path: bulk-collect parameters of MLA + SA
+                    idx = 0
+                    while idx < len(msg_data):
+                        n = min(256 - len(params) , len(msg_data) - idx)
+                        params.extend(msg_data[ idx:idx + n ])
+                        idx += n
+                        if len(params) == 256:
+                            yield ListenCmd(sec_addr , params)
+                            params = bytearray()
+                else:
+                    pending.extend(('D' , b) for b in msg_data)
+                continue
             if debug_print:
                 s = ""
                 if (signals & 1) == 0 and msg_type == 'D':
@@ -457,7 +589,7 @@ class DriveState:
             elif msg_type == 'Q':
                 continue
             elif msg_type == 'X':
-                self.io.send_msg('Y' , 0)
+                io.send_msg('Y' , 0)
                 continue
             elif msg_type == 'Y':
                 yield CPReachedCmd(msg_data != 0)
@@ -569,8 +701,7 @@ class DriveState:
             unit = self.units[ self.current_unit ]
             chs = unit.get_current_chs()
             print("WR {} ({},{},{})".format(unit.current_lba , chs[ 0 ] , chs[ 1 ] , chs[ 2 ]))
-            self.buffer_[ :len(c.params) ] = c.params
-            unit.write_img(self.buffer_)
+            unit.write_img(c.params)
             self.clear_errors()
             if self.cmd_seq_state == 3:
                 self.set_seq_state(0)
@@ -582,7 +713,7 @@ class DriveState:
                 self.set_error(0x1f)
                 unit.a_bit = True
                 try:
-                    chs = (c.params[ 2 ] * 256 + c.params[ 3 ] , c.params[ 4 ] , c.params[ 5 ])
+                    chs = struct.unpack_from(">HBB" , c.params , 2)
                     print("Seek ({},{},{})".format(chs[ 0 ] , chs[ 1 ] , chs[ 2 ]))
                     unit.set_current_chs(chs)
                     self.clear_dsj()
@@ -627,7 +758,7 @@ class DriveState:
         if self.require_seq_state(0 , False) and self.is_dsj_ok():
             unit = self.select_unit_check_f(c.params[ 1 ])
             if unit:
-                sec_count = c.params[ 2 ] * 256 + c.params[ 3 ]
+                sec_count = struct.unpack_from(">H" , c.params , 2)[ 0 ]
                 print("Verify {} sectors".format(sec_count))
                 if sec_count == 0:
                     # Verify to end of disk
@@ -648,7 +779,7 @@ class DriveState:
                 self.set_error(0x1f)
                 unit.a_bit = True
                 try:
-                    chs = (c.params[ 2 ] * 256 + c.params[ 3 ] , c.params[ 4 ] , c.params[ 5 ])
+                    chs = struct.unpack_from(">HBB" , c.params , 2)
                     print("Set addr. rec. ({},{},{})".format(chs[ 0 ] , chs[ 1 ] , chs[ 2 ]))
                     unit.set_current_chs(chs)
                     self.clear_dsj()
@@ -693,7 +824,7 @@ class DriveState:
             if unit and not self.dsj1_holdoff() and not self.lba_out_of_range():
                 chs = unit.get_current_chs()
                 print("RD {} ({},{},{})".format(unit.current_lba , chs[ 0 ] , chs[ 1 ] , chs[ 2 ]))
-                self.buffer_ = unit.read_img()
+                unit.read_img(self.buffer_)
                 self.clear_errors()
                 self.set_seq_state(2)
 
@@ -716,8 +847,7 @@ class DriveState:
 
     def cmd_tx_data(self, c):
         if self.require_seq_state(2 , True):
-            self.io.send_data(self.buffer_)
-            self.send_checkpoint()
+            self.io.send_data_with_checkpoint(self.buffer_)
             if self.unbuffered:
                 self.set_seq_state(5)
                 self.pp_enabled = False
@@ -734,30 +864,25 @@ class DriveState:
                 if unit.is_lba_ok():
                     chs = unit.get_current_chs()
                     print("RD {} ({},{},{})".format(unit.current_lba , chs[ 0 ] , chs[ 1 ] , chs[ 2 ]))
-                    self.buffer_ = unit.read_img()
-                    self.io.send_data(self.buffer_)
-                    self.send_checkpoint()
+                    unit.read_img(self.buffer_)
+                    self.io.send_data_with_checkpoint(self.buffer_)
                     self.pp_enabled = False
                 else:
-                    self.send_end_byte()
-                    self.send_checkpoint()
+                    self.io.send_data_with_checkpoint(b"\x01" , True)
                     self.set_seq_state(0)
                     self.pp_enabled = True
             self.set_pp(True)
 
     def cmd_tx_status(self, c):
         if self.require_seq_state(1 , True):
-            self.io.send_data(self.status)
             # Add a 0x01 byte with EOI
-            self.send_end_byte()
-            self.send_checkpoint()
+            self.io.send_data_with_checkpoint(self.status + b"\x01" , True)
             self.set_seq_state(0)
 
     def cmd_dsj(self, c):
         if self.require_seq_state(0 , True):
             print("DSJ={}".format(self.dsj))
-            self.io.send_data([ self.dsj ] , True)
-            self.send_checkpoint()
+            self.io.send_data_with_checkpoint([ self.dsj ] , True)
             if self.dsj == 2:
                 self.dsj = 0
         self.pp_enabled = False
@@ -818,6 +943,9 @@ class DriveState:
         (0x0c ,   5 , 0x18) : ("Format"               , cmd_format)
     }
 
+    # Same table keyed by (length << 13) | (secondary address << 8) | opcode
+    LISTEN_CMDS_INT = { (k[ 1 ] << 13) | (k[ 0 ] << 8) | k[ 2 ] : v for k , v in LISTEN_CMDS.items() }
+
     # Talk command decoding table
     # Secondary address is key
     TALK_CMDS = {
@@ -826,54 +954,73 @@ class DriveState:
         0x10 : ("DSJ"              , cmd_dsj)
     }
 
+    # Command decoders, by type of bus command
+    def decode_listen(self , c):
+        len_params = len(c.params)
+        # Match receive data cmd
+        if len_params > 0 and c.sec_addr == 0:
+            return ("Receive data" , DriveState.cmd_rx_data)
+        elif c.sec_addr == 0x10 and len_params == 1:
+            return ("Amigo clear" , DriveState.cmd_amigo_clear)
+        else:
+            key = (len_params << 13) | (c.sec_addr << 8) | (c.params[ 0 ] if len_params > 0 else 0)
+            return DriveState.LISTEN_CMDS_INT.get(key) or ("Unknown" , DriveState.cmd_unknown_listen)
+
+    def decode_talk(self , c):
+        return DriveState.TALK_CMDS.get(c.sec_addr) or ("Unknown" , DriveState.cmd_unknown_talk)
+
+    def decode_identify(self , c):
+        return (str(c) , DriveState.cmd_identify)
+
+    def decode_parallel_poll(self , c):
+        return (str(c) , DriveState.cmd_parallel_poll)
+
+    def decode_dev_clear(self , c):
+        return (str(c) , DriveState.cmd_dev_clear)
+
+    def decode_cp_reached(self , c):
+        return (str(c) , DriveState.cmd_cp_reached)
+
+    DECODERS = {
+        ListenCmd    : decode_listen,
+        TalkCmd      : decode_talk,
+        IdentifyCmd  : decode_identify,
+        ParallelPoll : decode_parallel_poll,
+        DeviceClear  : decode_dev_clear,
+        CPReachedCmd : decode_cp_reached
+    }
+
     def get_decoded_cmd(self):
+        decoders = DriveState.DECODERS
         for c in self.get_cmd():
-            if isinstance(c , ListenCmd):
-                len_params = len(c.params)
-                # Match receive data cmd
-                if len_params > 0 and c.sec_addr == 0:
-                    c.cmd = ("Receive data" , DriveState.cmd_rx_data)
-                elif c.sec_addr == 0x10 and len_params == 1:
-                    c.cmd = ("Amigo clear" , DriveState.cmd_amigo_clear)
-                else:
-                    key_tuple = (c.sec_addr , len_params , c.params[ 0 ] if (len_params > 0) else None)
-                    try:
-                        c.cmd = DriveState.LISTEN_CMDS[ key_tuple ]
-                    except KeyError:
-                        c.cmd = ("Unknown" , DriveState.cmd_unknown_listen)
-            elif isinstance(c , TalkCmd):
-                try:
-                    c.cmd = DriveState.TALK_CMDS[ c.sec_addr ]
-                except KeyError:
-                    c.cmd = ("Unknown" , DriveState.cmd_unknown_talk)
-            elif isinstance(c , IdentifyCmd):
-                c.cmd = (str(c) , DriveState.cmd_identify)
-            elif isinstance(c , ParallelPoll):
-                c.cmd = (str(c) , DriveState.cmd_parallel_poll)
-            elif isinstance(c , DeviceClear):
-                c.cmd = (str(c) , DriveState.cmd_dev_clear)
-            elif isinstance(c , CPReachedCmd):
-                c.cmd = (str(c) , DriveState.cmd_cp_reached)
-            else:
-                c.cmd = None
+            decoder = decoders.get(type(c))
+            c.cmd = decoder(self , c) if decoder else None
             yield c
 
     def exec_cmd(self, c):
-        is_tl_cmd = isinstance(c , ListenCmd) or isinstance(c , TalkCmd)
+        is_tl_cmd = type(c) in TL_CMD_TYPES
         if is_tl_cmd:
             self.pp_enabled = True
         c.cmd[ 1 ](self , c)
-        if is_tl_cmd:
+        # set_pp(True) is a no-op unless PP state differs from pp_enabled
+        if is_tl_cmd and self.pp_enabled != self.pp_state:
             self.set_pp(True)
 
 def main():
     parser = argparse.ArgumentParser(description="Emulation of Amigo drives")
-    parser.add_argument('-p' , '--port' , default = 1234 , type = int , help = "TCP port of MAME remotizer (defaults to 1234)")
+    parser.add_argument('-p' , '--port' , default = 1234 , type = int , help = "TCP port of MAME remotizer (defaults to 1234). " + rem488.SOCK_BUF_HELP)
     parser.add_argument('-d' , '--dbg' , type = argparse.FileType('wt') , help = "File for debug output")
     parser.add_argument('model' , nargs=1 , help = "Drive model")
-    parser.add_argument('img_file' , nargs='*' , type = argparse.FileType('r+b') , help = "Image file(s)")
+    parser.add_argument('img_file' , nargs='*' , help = "Image file(s)")
     args = parser.parse_args()
 
+    images = []
+    for f in args.img_file:
+        try:
+            images.append(open(f , "r+b"))
+        except OSError as e:
+            parser.error("can't open '{}': {}".format(f , e))
+
     try:
         fixed = FixedDriveData(args.model[ 0 ])
     except UnknownModel:
@@ -886,6 +1033,11 @@ def main():
     debug_print = args.dbg
 
     io = socket.socket()
+    # Buffer sizes must be set before connecting/listening to take part in
+    # TCP window scale negotiation (accepted sockets inherit them)
+    io.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, rem488.SOCK_BUF_SIZE)
+    io.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rem488.SOCK_BUF_SIZE)
+    rem488.set_tcp_opt(io , "TCP_FASTOPEN_CONNECT" , 1)
     try:
         io.connect(("localhost" , args.port))
         sock_io = io
@@ -893,20 +1045,29 @@ def main():
         print("Client connection unsuccessful, start as server..")
         io.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         io.bind(('0.0.0.0' , args.port))
+        rem488.set_tcp_opt(io , "TCP_FASTOPEN" , TFO_QUEUE_LEN)
         io.listen(1)
         conn , addr = io.accept()
         io.close()
         print("Connection from {}".format(addr))
         sock_io = conn
     sock_io.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    rem488.set_tcp_opt(sock_io , "TCP_QUICKACK" , 1)
     with sock_io:
         intf = Remote488MsgIO(sock_io)
-        state = DriveState(intf , fixed , 0 , args.img_file)
-        for c in state.get_decoded_cmd():
-            if debug_print:
-                print(str(c) , file = debug_print)
-            print(c.cmd[ 0 ])
-            state.exec_cmd(c)
+        state = DriveState(intf , fixed , 0 , images)
+        try:
+            for c in state.get_decoded_cmd():
+                if debug_print:
+                    print(str(c) , file = debug_print)
+                print(c.cmd[ 0 ])
+                state.exec_cmd(c)
+        finally:
+            for unit in state.units:
+                unit.close()
+            # Images in excess of unit count
+            for img in images:
+                img.close()
     if debug_print:
         debug_print.close()
 
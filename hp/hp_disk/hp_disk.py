@@ -18,6 +18,9 @@
 
 import sys
 import os.path
+import json
+import base64
+from functools import partial
 from PyQt6 import QtCore, QtGui, QtWidgets
 
 from main import Ui_MainWindow
@@ -39,15 +42,19 @@ class MyMainWindow(QtWidgets.QMainWindow):
         self.unit_file = self.instances_to_list("file")
         self.unit_load = self.instances_to_list("load")
         for n in range(self.N_UNITS):
-            f = (lambda n: lambda : self.load_image(n))(n)
-            self.unit_load[ n ].clicked.connect(f)
+            self.unit_load[ n ].clicked.connect(partial(self.load_image , n))
         self.unit_loaded = [ False ] * self.N_UNITS
+        # Image loading was requested by user
+        self.unit_user_load = [ False ] * self.N_UNITS
+        # Image loading is in progress
+        self.unit_loading = [ False ] * self.N_UNITS
         self.unit_readonly = self.instances_to_list("readonly")
         for n in range(self.N_UNITS):
-            f = (lambda n: lambda state: self.set_read_only(n , state))(n)
-            self.unit_readonly[ n ].clicked.connect(f)
+            self.unit_readonly[ n ].clicked.connect(partial(self.set_read_only , n))
         self.rd_counter = [ 0 ] * self.N_UNITS
         self.wr_counter = [ 0 ] * self.N_UNITS
+        self.rd_dirty = [ False ] * self.N_UNITS
+        self.wr_dirty = [ False ] * self.N_UNITS
         self.unit_read = self.instances_to_list("read")
         self.unit_write = self.instances_to_list("write")
         self.unit_lba = self.instances_to_list("lba")
@@ -57,52 +64,72 @@ class MyMainWindow(QtWidgets.QMainWindow):
         self.unit_capacity = self.instances_to_list("capacity")
         self.unit_geometry = self.instances_to_list("geometry")
         self.unit_bps = self.instances_to_list("bps")
+        # Geometry/capacity/bps strings of units, by model index
+        self.unit_strings = {}
+        # Last position shown for each unit (LBA , Cylinder , Head , Sector)
+        self.last_pos = [ None ] * self.N_UNITS
         for model in hp_disk_protocol.DRIVE_MODELS:
             self.ui.drive_model.addItem(model.name)
         self.set_connected_state(False)
         self.io.status_connect.connect(self.conn_status)
-        self.io.rd_counter.connect(self.inc_rd_counter)
-        self.io.wr_counter.connect(self.inc_wr_counter)
+        self.io.set_counter_receiver(self)
         self.io.curr_pos.connect(self.set_current_pos)
-        self.act_timers = []
-        for n in range(self.N_UNITS):
-            timer = QtCore.QTimer()
-            f = (lambda n: lambda : self.act_timer_to(n))(n)
-            timer.timeout.connect(f)
-            timer.setSingleShot(True)
-            self.act_timers.append(timer)
+        self.io.load_status.connect(self.load_done)
+        # Tab color is reset 100 ms after last activity on unit
+        self.act_last = [ 0 ] * self.N_UNITS
+        self.act_on = [ False ] * self.N_UNITS
+        self.tab_color = [ QtCore.Qt.GlobalColor.black ] * self.N_UNITS
+        self.act_clock = QtCore.QElapsedTimer()
+        self.act_clock.start()
+        # Counters & activity are refreshed at most once every 33 ms
+        self.ui_timer = QtCore.QTimer()
+        self.ui_timer.timeout.connect(self.flush_counters)
+        self.ui_timer.start(33)
         for n in range(self.N_UNITS):
             self.clear_status(n)
         self.io.set_address(0)
+        # Settings are saved 500 ms after last change
+        self.settings = QtCore.QSettings("hp_disk")
+        self.save_timer = QtCore.QTimer(self)
+        self.save_timer.setSingleShot(True)
+        self.save_timer.timeout.connect(self.save_settings)
         self.load_settings()
+        # Nothing changed yet
+        self.save_timer.stop()
 
     def instances_to_list(self , suffix):
-        l = [ self.ui.__dict__[ f"unit{n}_{suffix}" ] for n in range(self.N_UNITS) ]
-        return l
+        return [ getattr(self.ui , f"unit{n}_{suffix}") for n in range(self.N_UNITS) ]
 
     # SLOT
     def set_model(self , model_idx):
         model = hp_disk_protocol.DRIVE_MODELS[ model_idx ]
         self.ui.drive_protocol.setText(model.protocol)
         self.io.set_model(model_idx)
+        strings = self.unit_strings.get(model_idx)
+        if strings is None:
+            strings = []
+            for unit in self.io.drive.units[ :self.N_UNITS ]:
+                g = unit.geometry.max_chs
+                size = unit.geometry.max_lba * unit.bps
+                strings.append((f"{g[ 0 ]}x{g[ 1 ]}x{g[ 2 ]}" , f"{(size + 1023) // 1024} k" , str(unit.bps)))
+            self.unit_strings[ model_idx ] = strings
         for n in range(self.N_UNITS):
             self.clear_status(n)
             if n < len(model.unit_specs):
                 self.ui.drives.setTabEnabled(n, True)
-                geometry = self.io.drive.units[ n ].geometry
-                g = geometry.max_chs
-                bps = self.io.drive.units[ n ].bps
-                size = geometry.max_lba * bps
-                self.unit_geometry[ n ].setText(f"{g[ 0 ]}x{g[ 1 ]}x{g[ 2 ]}")
-                self.unit_capacity[ n ].setText(f"{(size + 1023) // 1024} k")
-                self.unit_bps[ n ].setText(f"{bps}")
+                geo_str , cap_str , bps_str = strings[ n ]
+                self.unit_geometry[ n ].setText(geo_str)
+                self.unit_capacity[ n ].setText(cap_str)
+                self.unit_bps[ n ].setText(bps_str)
             else:
                 self.ui.drives.setTabEnabled(n, False)
+        self.schedule_save()
 
     # SLOT
     def set_address(self , addr):
         if not self.connected:
             self.io.set_address(addr)
+            self.schedule_save()
 
     # SLOT
     def conn_status(self , status , msg):
@@ -116,28 +143,47 @@ class MyMainWindow(QtWidgets.QMainWindow):
             self.ui.statusbar.showMessage("Connection failure")
             self.set_connected_state(False)
 
-    def load_file(self , unit , filename):
-        status = self.io.load_image(unit , filename)
+    # Image file is loaded by IOThread, outcome is reported by load_done
+    # Unit widgets stay disabled until then, even across a model change
+    def load_file(self , unit , filename , user_load = False):
+        self.unit_user_load[ unit ] = user_load
+        self.unit_loading[ unit ] = True
+        self.unit_file[ unit ].setText("Loading...")
+        self.unit_load[ unit ].setEnabled(False)
+        self.unit_readonly[ unit ].setEnabled(False)
+        self.io.request_load.emit(unit , filename , self.io.model_gen)
+
+    # SLOT
+    def load_done(self , unit , status , filename , model_gen):
+        self.unit_loading[ unit ] = False
+        self.unit_load[ unit ].setEnabled(True)
+        if model_gen != self.io.model_gen:
+            # Model was changed in the meantime: outcome no longer applies
+            self.unit_readonly[ unit ].setEnabled(True)
+            return
         if status == 0:
             self.unit_filenames[ unit ] = filename
             self.unit_file[ unit ].setText(os.path.basename(filename))
             self.unit_load[ unit ].setText("Unload")
             self.unit_loaded[ unit ] = True
-            self.unit_readonly[ unit ].setEnabled(False)
         else:
             self.clear_image_file(unit)
-        return status
+        self.clear_counters(unit)
+        self.clear_pos(unit)
+        if self.unit_user_load[ unit ]:
+            if status != 0:
+                QtWidgets.QMessageBox.critical(self , "Error" , f"Can't open file {filename} (err={status})")
+            self.schedule_save()
 
     def load_image(self , unit):
         if self.unit_loaded[ unit ]:
             self.io.load_image(unit , None)
             self.clear_image_file(unit)
+            self.schedule_save()
         else:
             f = QtWidgets.QFileDialog.getOpenFileName(self , f"Select image file for unit {unit}")
             if f[ 0 ]:
-                status = self.load_file(unit , f[ 0 ])
-                if status != 0:
-                    QtWidgets.QMessageBox.critical(self , "Error" , f"Can't open file {f[ 0 ]} (err={status})")
+                self.load_file(unit , f[ 0 ] , True)
         self.clear_counters(unit)
         self.clear_pos(unit)
 
@@ -151,10 +197,11 @@ class MyMainWindow(QtWidgets.QMainWindow):
         self.unit_file[ unit ].setText("")
         self.unit_load[ unit ].setText("Load")
         self.unit_loaded[ unit ] = False
-        self.unit_readonly[ unit ].setEnabled(True)
+        self.unit_readonly[ unit ].setEnabled(not self.unit_loading[ unit ])
 
     def set_read_only(self , unit , state):
         self.io.set_read_only(unit , state)
+        self.schedule_save()
 
     def set_connected_state(self , connected):
         self.connected = connected
@@ -164,93 +211,184 @@ class MyMainWindow(QtWidgets.QMainWindow):
     def clear_counters(self , unit):
         self.rd_counter[ unit ] = 0
         self.wr_counter[ unit ] = 0
+        self.rd_dirty[ unit ] = False
+        self.wr_dirty[ unit ] = False
         self.unit_read[ unit ].setNum(0)
         self.unit_write[ unit ].setNum(0)
 
-    # SLOT
     def inc_rd_counter(self , unit , delta):
         if delta > 0:
             self.rd_counter[ unit ] += delta
-            self.unit_read[ unit ].setNum(self.rd_counter[ unit ])
-            self.ui.drives.tabBar().setTabTextColor(unit, QtCore.Qt.GlobalColor.green)
-            self.act_timers[ unit ].start(100)
+            self.rd_dirty[ unit ] = True
 
-    # SLOT
     def inc_wr_counter(self , unit , delta):
         if delta > 0:
             self.wr_counter[ unit ] += delta
-            self.unit_write[ unit ].setNum(self.wr_counter[ unit ])
-            self.ui.drives.tabBar().setTabTextColor(unit, QtCore.Qt.GlobalColor.red)
-            self.act_timers[ unit ].start(100)
+            self.wr_dirty[ unit ] = True
+
+    # Batched counters from IOThread
+    def customEvent(self , event):
+        if event.type() == hp_disk_protocol.CounterEvent.TYPE:
+            for unit in range(min(len(event.rd) , self.N_UNITS)):
+                self.inc_rd_counter(unit , event.rd[ unit ])
+                self.inc_wr_counter(unit , event.wr[ unit ])
+        else:
+            QtWidgets.QMainWindow.customEvent(self , event)
 
     # SLOT
+    def flush_counters(self):
+        now = self.act_clock.elapsed()
+        for unit in range(self.N_UNITS):
+            if self.rd_dirty[ unit ]:
+                self.rd_dirty[ unit ] = False
+                self.unit_read[ unit ].setNum(self.rd_counter[ unit ])
+                self.set_tab_color(unit , QtCore.Qt.GlobalColor.green)
+                self.act_last[ unit ] = now
+                self.act_on[ unit ] = True
+            if self.wr_dirty[ unit ]:
+                self.wr_dirty[ unit ] = False
+                self.unit_write[ unit ].setNum(self.wr_counter[ unit ])
+                self.set_tab_color(unit , QtCore.Qt.GlobalColor.red)
+                self.act_last[ unit ] = now
+                self.act_on[ unit ] = True
+            if self.act_on[ unit ] and now - self.act_last[ unit ] >= 100:
+                self.act_timer_to(unit)
+
     def act_timer_to(self, unit):
-        self.ui.drives.tabBar().setTabTextColor(unit, QtCore.Qt.GlobalColor.black)
+        self.act_on[ unit ] = False
+        self.set_tab_color(unit , QtCore.Qt.GlobalColor.black)
+
+    def set_tab_color(self , unit , color):
+        # Changing tab text color repaints the tab bar: skip it when color doesn't change
+        if self.tab_color[ unit ] != color:
+            self.tab_color[ unit ] = color
+            self.ui.drives.tabBar().setTabTextColor(unit, color)
 
     def clear_pos(self , unit):
         self.unit_lba[ unit ].setNum(0)
         self.unit_cyl[ unit ].setNum(0)
         self.unit_head[ unit ].setNum(0)
         self.unit_sec[ unit ].setNum(0)
+        self.last_pos[ unit ] = (0 , 0 , 0 , 0)
 
     # SLOT
     def set_current_pos(self , unit , lba , cyl , head , sec):
-        self.unit_lba[ unit ].setNum(lba)
-        self.unit_cyl[ unit ].setNum(cyl)
-        self.unit_head[ unit ].setNum(head)
-        self.unit_sec[ unit ].setNum(sec)
+        # Only update labels whose value changed
+        last = self.last_pos[ unit ]
+        if lba != last[ 0 ]:
+            self.unit_lba[ unit ].setNum(lba)
+        if cyl != last[ 1 ]:
+            self.unit_cyl[ unit ].setNum(cyl)
+        if head != last[ 2 ]:
+            self.unit_head[ unit ].setNum(head)
+        if sec != last[ 3 ]:
+            self.unit_sec[ unit ].setNum(sec)
+        self.last_pos[ unit ] = (lba , cyl , head , sec)
+
+    def schedule_save(self):
+        self.save_timer.start(500)
+
+    def settings_cache_path(self):
+        cfg_dir = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.StandardLocation.AppConfigLocation)
+        return os.path.join(cfg_dir , "hp_disk.json")
 
+    # Settings are read from JSON cache when available, from QSettings otherwise
     def load_settings(self):
-        settings = QtCore.QSettings("hp_disk")
-        settings.beginGroup("MainWindow")
-        geo = settings.value("geometry")
+        try:
+            with open(self.settings_cache_path() , "rb") as f:
+                d = json.load(f)
+            geo = d.get("geometry")
+            geo = QtCore.QByteArray(base64.b64decode(geo)) if geo else None
+            model = int(d.get("model" , 0))
+            address = int(d.get("address" , 0))
+            units = [ (u.get("file") , bool(u.get("readonly" , False))) for u in d.get("units" , []) ]
+        except (OSError , ValueError , TypeError , AttributeError):
+            settings = self.settings
+            settings.beginGroup("MainWindow")
+            geo = settings.value("geometry")
+            settings.endGroup()
+            settings.beginGroup("Drive")
+            model = settings.value("model" , 0 , int)
+            address = settings.value("address" , 0 , int)
+            settings.endGroup()
+            n = settings.beginReadArray("Unit")
+            set_idx = settings.setArrayIndex
+            value = settings.value
+            units = []
+            for i in range(n):
+                set_idx(i)
+                units.append((value("file") , value("readonly" , False , bool)))
+            settings.endArray()
         if geo:
             self.restoreGeometry(geo)
-        settings.endGroup()
-        settings.beginGroup("Drive")
-        x = settings.value("model" , 0 , int)
-        self.ui.drive_model.setCurrentIndex(x)
-        x = settings.value("address" , 0 , int)
-        self.ui.drive_addr.setValue(x)
-        settings.endGroup()
-        n = min(settings.beginReadArray("Unit") , self.N_UNITS , self.io.get_unit_count())
-        read_only = self.instances_to_list("readonly")
-        for i in range(n):
-            settings.setArrayIndex(i)
-            ro = settings.value("readonly" , False , bool)
-            read_only[ i ].setChecked(ro)
-            self.set_read_only(i , ro)
-            filename = settings.value("file")
-            if filename:
-                self.load_file(i , filename)
-        settings.endArray()
+        # Slots are called explicitly once, with signals of affected widgets blocked
+        blocker = QtCore.QSignalBlocker(self.ui.drive_model)
+        try:
+            self.ui.drive_model.setCurrentIndex(model)
+        finally:
+            blocker.unblock()
+        self.set_model(self.ui.drive_model.currentIndex())
+        self.ui.drive_addr.setValue(address)
+        blockers = [ QtCore.QSignalBlocker(w) for w in self.unit_readonly + self.unit_load + self.unit_file ]
+        try:
+            n = min(len(units) , self.N_UNITS , self.io.get_unit_count())
+            for i in range(n):
+                filename , ro = units[ i ]
+                self.unit_readonly[ i ].setChecked(ro)
+                self.set_read_only(i , ro)
+                if filename:
+                    self.load_file(i , filename)
+        finally:
+            for blocker in blockers:
+                blocker.unblock()
+        self.update()
 
+    # SLOT
     def save_settings(self):
-        settings = QtCore.QSettings("hp_disk")
+        geo = self.saveGeometry()
+        model = self.ui.drive_model.currentIndex()
+        address = self.ui.drive_addr.value()
+        units = [ (self.unit_filenames[ i ] , self.unit_readonly[ i ].isChecked()) for i in range(self.N_UNITS) ]
+        settings = self.settings
         settings.beginGroup("MainWindow")
-        settings.setValue("geometry" , self.saveGeometry())
+        settings.setValue("geometry" , geo)
         settings.endGroup()
         settings.beginGroup("Drive")
-        settings.setValue("model" , self.ui.drive_model.currentIndex())
-        settings.setValue("address" , self.ui.drive_addr.value())
+        settings.setValue("model" , model)
+        settings.setValue("address" , address)
         settings.endGroup()
         settings.beginWriteArray("Unit" , self.N_UNITS)
-        read_only = self.instances_to_list("readonly")
-        read_only_values = [ ro.isChecked() for ro in read_only ]
-        for i in range(self.N_UNITS):
-            settings.setArrayIndex(i)
-            settings.setValue("file" , self.unit_filenames[ i ])
-            settings.setValue("readonly" , read_only_values[ i ])
+        set_idx = settings.setArrayIndex
+        set_value = settings.setValue
+        for i , (filename , ro) in enumerate(units):
+            set_idx(i)
+            set_value("file" , filename)
+            set_value("readonly" , ro)
         settings.endArray()
+        settings.sync()
+        d = {
+            "geometry": base64.b64encode(geo.data()).decode("ascii"),
+            "model": model,
+            "address": address,
+            "units": [ { "file": filename , "readonly": ro } for filename , ro in units ]
+        }
+        path = self.settings_cache_path()
+        try:
+            os.makedirs(os.path.dirname(path) , exist_ok = True)
+            with open(path , "w") as f:
+                json.dump(d , f)
+        except OSError:
+            pass
 
     def closeEvent(self , event):
+        self.save_timer.stop()
         self.save_settings()
         event.accept()
 
 def get_options(app):
     parser = QtCore.QCommandLineParser()
     parser.addHelpOption()
-    port_opt = QtCore.QCommandLineOption([ "p" , "port" ] , "Set TCP port fo remote488." , "TCP port" , str(DEFAULT_PORT))
+    port_opt = QtCore.QCommandLineOption([ "p" , "port" ] , "Set TCP port fo remote488. " + rem488.SOCK_BUF_HELP , "TCP port" , str(DEFAULT_PORT))
     parser.addOption(port_opt)
     parser.process(app)
     try:
@@ -272,4 +410,6 @@ if __name__ == '__main__':
     myapp = MyMainWindow(iot)
     iot.start()
     myapp.show()
-    sys.exit(app.exec())
+    status = app.exec()
+    iot.stop()
+    sys.exit(status)
@@ -20,15 +20,26 @@ from PyQt6 import QtCore
 import rem488
 import threading
 import struct
+import os
+import mmap
+import time
 from collections import namedtuple
 
 UnitSpec = namedtuple("UnitSpec", [ "geometry", "fixed" , "ignore_fmt", "unit_desc", "vol_il" ])
 DriveModel = namedtuple("DriveModel" , [ "name", "id", "protocol", "cont_desc", "unit_specs" ])
 
+# Precompiled formats of protocol fields
+STRUCT_CHS = struct.Struct(">HBB")
+STRUCT_U16 = struct.Struct(">H")
+STRUCT_U32 = struct.Struct(">L")
+STRUCT_U64 = struct.Struct(">Q")
+STRUCT_PARAM = struct.Struct(">HL")
+STRUCT_VOL = struct.Struct(">xHBHxxLB")
+
 class CHSOutOfRange(Exception):
     def __init__(self, chs , max_chs):
         self.chs = chs
-        self.max_chs = chs
+        self.max_chs = max_chs
 
     def __str__(self):
         return "({},{},{}) out of range, max = ({},{},{})".format(self.chs[ 0 ] , self.chs[ 1 ] , self.chs[ 2 ] , self.max_chs[ 0 ] - 1 ,  self.max_chs[ 1 ] - 1 ,  self.max_chs[ 2 ] - 1)
@@ -36,7 +47,7 @@ class CHSOutOfRange(Exception):
 class LBAOutOfRange(Exception):
     def __init__(self, lba , max_lba):
         self.lba = lba
-        self.max_lba = lba
+        self.max_lba = max_lba
 
     def __str__(self):
         return "LBA {} out of range, max = {}".format(self.lba , self.max_lba)
@@ -45,23 +56,143 @@ class Geometry:
     def __init__(self, chs):
         self.max_chs = chs
         self.max_lba = chs[ 0 ] * chs[ 1 ] * chs[ 2 ]
+        self.n_cyls , self.n_heads , self.n_secs = chs
+        self.secs_per_cyl = self.n_heads * self.n_secs
 
     def chs_to_lba(self, chs):
-        c, h, s = self.max_chs
-        if 0 <= chs[ 0 ] < c and\
-           0 <= chs[ 1 ] < h and\
-           0 <= chs[ 2 ] < s:
-            return (chs[ 0 ] * h + chs[ 1 ]) * s + chs[ 2 ]
+        c , h , s = chs
+        if 0 <= c < self.n_cyls and 0 <= h < self.n_heads and 0 <= s < self.n_secs:
+            return c * self.secs_per_cyl + h * self.n_secs + s
         else:
             raise CHSOutOfRange(chs , self.max_chs)
 
     def lba_to_chs(self, lba):
         if lba < 0 or lba >= self.max_lba:
             raise LBAOutOfRange(lba , self.max_lba)
-        tmp , s = divmod(lba , self.max_chs[ 2 ])
-        c , h = divmod(tmp , self.max_chs[ 1 ])
+        c , tmp = divmod(lba , self.secs_per_cyl)
+        h , s = divmod(tmp , self.n_secs)
         return (c , h , s)
 
+# Positioned I/O (pread/pwrite) is not available everywhere (e.g. Windows)
+HAS_PIO = hasattr(os , "pread") and hasattr(os , "pwrite")
+
+# Size of blocks written when formatting
+FILL_CHUNK = 1 << 20
+# Size of read-ahead for images accessed through file I/O
+READ_AHEAD = 64 * 1024
+# Fill blocks, by filler byte (a few at most are kept)
+FILL_CACHE = {}
+FILL_CACHE_MAX = 4
+
+class ImageFile:
+    # Image file of a unit
+    # Images covering the whole unit are memory-mapped so that sector I/O
+    # becomes a plain copy to/from the page cache. Shorter images (e.g. empty
+    # files that are about to be formatted) are accessed through file I/O.
+    def __init__(self, image_file, read_only, size):
+        # Every access is positioned explicitly: Python buffering would only add a copy
+        self.file = open(image_file , "rb" if read_only else "r+b" , buffering = 0)
+        self.fd = self.file.fileno()
+        self.read_only = read_only
+        # Current file offset, to skip seeks during sequential access (no pread/pwrite only)
+        self.file_pos = 0
+        # Read-ahead data & its position (unmapped images only)
+        self.ra_buf = None
+        self.ra_pos = 0
+        self.map = None
+        try:
+            if size > 0 and os.fstat(self.file.fileno()).st_size >= size:
+                self.map = mmap.mmap(self.file.fileno() , size , access = mmap.ACCESS_READ if read_only else mmap.ACCESS_WRITE)
+                self.map_mv = memoryview(self.map)
+                self.map_size = size
+        except (OSError , ValueError):
+            self.map = None
+
+    def close(self):
+        if self.map is not None:
+            if not self.read_only:
+                self.map.flush()
+            self.map_mv.release()
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def seek(self, pos):
+        if pos != self.file_pos:
+            self.file.seek(pos)
+            self.file_pos = pos
+
+    # Read into "buf", return number of bytes read
+    def readinto(self, pos, buf):
+        if self.map is not None:
+            end = pos + len(buf)
+            if end <= self.map_size:
+                # The usual case: mapping covers the whole unit
+                buf[ : ] = self.map_mv[ pos:end ]
+                return len(buf)
+            n = max(0 , self.map_size - pos)
+            buf[ :n ] = self.map_mv[ pos:pos + n ]
+            return n
+        ra = self.ra_buf
+        n = len(buf)
+        if ra is None or pos < self.ra_pos or pos + n > self.ra_pos + len(ra):
+            # Refill read-ahead
+            if HAS_PIO:
+                ra = os.pread(self.fd , max(n , READ_AHEAD) , pos)
+            else:
+                self.seek(pos)
+                ra = self.file.read(max(n , READ_AHEAD)) or b""
+                self.file_pos += len(ra)
+            ra = self.ra_buf = memoryview(ra)
+            self.ra_pos = pos
+        off = pos - self.ra_pos
+        n = max(0 , min(n , len(ra) - off))
+        buf[ :n ] = ra[ off:off + n ]
+        return n
+
+    def write(self, pos, data):
+        self.ra_buf = None
+        if self.map is not None:
+            self.map[ pos:pos + len(data) ] = data
+        else:
+            # Unbuffered writes may be partial
+            data = memoryview(data)
+            if not HAS_PIO:
+                self.seek(pos)
+            while data:
+                if HAS_PIO:
+                    n = os.pwrite(self.fd , data , pos)
+                else:
+                    n = self.file.write(data)
+                    self.file_pos += n
+                pos += n
+                data = data[ n: ]
+
+    # Fill first "size" bytes of image with "filler" byte, in large blocks
+    def fill(self, size, filler):
+        self.ra_buf = None
+        if self.map is None:
+            if filler == 0 and os.fstat(self.fd).st_size <= size:
+                # Zeroing a short image: let the file system provide (sparse) zeros
+                os.ftruncate(self.fd , 0)
+                os.ftruncate(self.fd , size)
+                return
+            if hasattr(os , "posix_fallocate"):
+                try:
+                    os.posix_fallocate(self.fd , 0 , size)
+                except OSError:
+                    pass
+        chunk = FILL_CACHE.get(filler)
+        if chunk is None:
+            if len(FILL_CACHE) >= FILL_CACHE_MAX:
+                FILL_CACHE.clear()
+            chunk = FILL_CACHE[ filler ] = bytes((filler,)) * FILL_CHUNK
+        pos = 0
+        while pos < size:
+            n = min(len(chunk) , size - pos)
+            self.write(pos , chunk if n == len(chunk) else memoryview(chunk)[ :n ])
+            pos += n
+
 #                             geometry      fixed  ignore_fmt unit_desc vol_il
 UNIT9885 = UnitSpec(Geometry(( 77, 2, 30)), False, False,     None,     None)
 UNIT9134 = UnitSpec(Geometry((306, 4, 31)), True,  True,      None,     None)
@@ -80,6 +211,8 @@ DRIVE_MODELS = [
 ]
 
 class AmigoUnitState:
+    __slots__ = ("geometry" , "bps" , "ignore_fmt" , "current_lba" , "rd_counter" , "wr_counter" , "a_bit" , "c_bit" , "f_bit" , "ss" , "tttt" , "image" , "read_only" , "rd_buf")
+
     def __init__(self, geometry, ignore_fmt):
         self.geometry = geometry
         self.bps = 256
@@ -91,13 +224,15 @@ class AmigoUnitState:
         self.c_bit = False
         self.image = None
         self.read_only = False
+        # Sectors are read into this buffer
+        self.rd_buf = bytearray(256)
         self.unload_image()
 
     def load_image(self , image_file):
         try:
             self.rd_counter = 0
             self.wr_counter = 0
-            self.image = open(image_file , "rb" if self.read_only else "r+b")
+            self.image = ImageFile(image_file , self.read_only , self.geometry.max_lba * self.bps)
             self.f_bit = True
             self.ss = 0
             self.tttt = 6
@@ -120,7 +255,7 @@ class AmigoUnitState:
             self.read_only = read_only
 
     def is_ready(self):
-        return self.image != None
+        return self.image is not None
 
     def set_current_chs(self, chs):
         try:
@@ -136,33 +271,36 @@ class AmigoUnitState:
         return self.geometry.lba_to_chs(self.current_lba)
 
     def write_img(self, data):
-        if self.is_ready() and not self.read_only:
-            self.image.seek(256 * self.current_lba)
-            self.image.write(data)
-            self.current_lba += 1
+        image = self.image
+        if image is not None and not self.read_only:
+            lba = self.current_lba
+            image.write(256 * lba , data)
+            self.current_lba = lba + 1
             self.wr_counter += 1
 
+    # Returned buffer is only valid until next call
     def read_img(self):
-        if self.is_ready():
-            self.image.seek(256 * self.current_lba)
-            data = bytearray(self.image.read(256))
-            if len(data) < 256:
-                data.extend(bytes(256 - len(data)))
-            self.current_lba += 1
+        data = self.rd_buf
+        image = self.image
+        if image is not None:
+            lba = self.current_lba
+            n = image.readinto(256 * lba , data)
+            if n < 256:
+                data[ n: ] = bytes(256 - n)
+            self.current_lba = lba + 1
             self.rd_counter += 1
         else:
-            data = bytearray(256)
+            data[ : ] = bytes(256)
         return data
 
     def format_img(self, filler):
-        if self.is_ready() and not self.read_only:
-            self.image.seek(0)
-            fill = bytes([ filler ] * 256)
-            for x in range(self.geometry.max_lba):
-                self.image.write(fill)
+        if self.image is not None and not self.read_only:
+            self.image.fill(256 * self.geometry.max_lba , filler)
             self.wr_counter += self.geometry.max_lba
 
 class AmigoDriveState:
+    __slots__ = ("io" , "fixed_data" , "n_units" , "units" , "dsj" , "stat1" , "pp_enabled" , "pp_state" , "buffer_" , "status" , "current_unit" , "failed_unit" , "cmd_seq_state" , "unbuffered" , "dirty_units")
+
     def __init__(self , io , fixed_data):
         self.io = io
         self.io.disable_unlisten_sa()
@@ -177,6 +315,8 @@ class AmigoDriveState:
         self.n_units = len(self.units)
         self.current_unit = 0
         self.failed_unit = 0
+        # Indexes of units other than the active one that may have changed
+        self.dirty_units = set()
         # 0     Idle
         # 1     Wait for send addr/status
         # 2     Wait for send data
@@ -192,13 +332,22 @@ class AmigoDriveState:
             self.pp_state = new_state
             self.io.send_pp_state(self.pp_state)
 
+    # Index of the unit the last command could have changed
+    def active_unit(self):
+        return self.current_unit
+
     def is_dsj_ok(self):
         return self.dsj != 2
 
+    def set_current_unit(self, unit):
+        if unit != self.current_unit:
+            self.dirty_units.add(self.current_unit)
+            self.current_unit = unit
+
     def select_unit(self, unit):
         if unit < self.n_units:
-            self.current_unit = unit
-            return self.units[ self.current_unit ]
+            self.set_current_unit(unit)
+            return self.units[ unit ]
         else:
             self.set_error(0x17)
             return None
@@ -278,8 +427,16 @@ class AmigoDriveState:
             self.set_seq_state(0)
         else:
             unit = self.units[ self.current_unit ]
-            chs = unit.get_current_chs()
-            self.buffer_[ :len(c.data) ] = c.data
+            if len(c.data) == 256 and isinstance(c.data , bytearray):
+                # Full sector: adopt received data as buffer instead of copying it
+                self.buffer_ = c.data
+            else:
+                n = len(c.data)
+                buf = self.buffer_
+                buf[ :n ] = c.data
+                if n < 256:
+                    # Pad short sectors with zeros
+                    buf[ n: ] = bytes(256 - n)
             unit.write_img(self.buffer_)
             self.clear_errors()
             if self.cmd_seq_state == 3:
@@ -292,7 +449,7 @@ class AmigoDriveState:
                 self.set_error(0x1f)
                 unit.a_bit = True
                 try:
-                    chs = (c.data[ 2 ] * 256 + c.data[ 3 ] , c.data[ 4 ] , c.data[ 5 ])
+                    chs = STRUCT_CHS.unpack_from(c.data , 2)
                     unit.set_current_chs(chs)
                     self.clear_dsj()
                 except CHSOutOfRange:
@@ -303,7 +460,7 @@ class AmigoDriveState:
             if c.data[ 1 ] < self.n_units:
                 self.status[ 0 ] = self.stat1
                 self.status[ 1 ] = self.failed_unit
-                self.current_unit = c.data[ 1 ]
+                self.set_current_unit(c.data[ 1 ])
                 unit = self.units[ self.current_unit ]
                 self.status[ 2 ] = unit.tttt << 1
                 if unit.c_bit or unit.ss != 0:
@@ -335,7 +492,7 @@ class AmigoDriveState:
         if self.require_seq_state(0 , False) and self.is_dsj_ok():
             unit = self.select_unit_check_f(c.data[ 1 ])
             if unit:
-                sec_count = c.data[ 2 ] * 256 + c.data[ 3 ]
+                sec_count = STRUCT_U16.unpack_from(c.data , 2)[ 0 ]
                 if sec_count == 0:
                     # Verify to end of disk
                     unit.current_lba = unit.geometry.max_lba
@@ -348,18 +505,8 @@ class AmigoDriveState:
         # TODO:
         pass
 
-    def cmd_set_addr_rec(self, c):
-        if self.require_seq_state(0 , False) and self.is_dsj_ok():
-            unit = self.select_unit_check_f(c.data[ 1 ])
-            if unit:
-                self.set_error(0x1f)
-                unit.a_bit = True
-                try:
-                    chs = (c.data[ 2 ] * 256 + c.data[ 3 ] , c.data[ 4 ] , c.data[ 5 ])
-                    unit.set_current_chs(chs)
-                    self.clear_dsj()
-                except CHSOutOfRange:
-                    unit.c_bit = True
+    # Set address record works just like seek
+    cmd_set_addr_rec = cmd_seek
 
     def cmd_download(self, c):
         self.set_seq_error(False)
@@ -396,8 +543,7 @@ class AmigoDriveState:
         if self.require_seq_state(0 , False) and self.is_dsj_ok():
             unit = self.select_unit_check_f(c.data[ 1 ])
             if unit and not self.dsj1_holdoff() and not self.lba_out_of_range():
-                chs = unit.get_current_chs()
-                self.buffer_ = unit.read_img()
+                self.buffer_[ : ] = unit.read_img()
                 self.clear_errors()
                 self.set_seq_state(2)
 
@@ -436,8 +582,7 @@ class AmigoDriveState:
             else:
                 unit = self.units[ self.current_unit ]
                 if unit.is_lba_ok():
-                    chs = unit.get_current_chs()
-                    self.buffer_ = unit.read_img()
+                    self.buffer_[ : ] = unit.read_img()
                     self.io.talk_data(self.buffer_)
                     self.send_checkpoint()
                     self.pp_enabled = False
@@ -478,6 +623,7 @@ class AmigoDriveState:
             u.f_bit = False
             u.c_bit = False
             u.current_lba = 0
+        self.dirty_units.update(range(self.n_units))
         self.current_unit = 0
         self.pp_enabled = True
         self.set_pp(True)
@@ -520,6 +666,9 @@ class AmigoDriveState:
         (0x0c ,   5 , 0x18) : cmd_format
     }
 
+    # Same table keyed by (length << 13) | (secondary address << 8) | opcode
+    LISTEN_CMDS_INT = { (k[ 1 ] << 13) | (k[ 0 ] << 8) | k[ 2 ] : v for k , v in LISTEN_CMDS.items() }
+
     # Talk command decoding table
     # Secondary address is key
     TALK_CMDS = {
@@ -528,8 +677,18 @@ class AmigoDriveState:
         0x10 : cmd_dsj
     }
 
+    # Commands for events other than listen/talk
+    # Event type is key
+    EV_CMDS = {
+        rem488.RemotizerIdentify  : cmd_identify,
+        rem488.RemotizerAddressed : cmd_parallel_poll,
+        rem488.RemotizerDevClear  : cmd_dev_clear,
+        rem488.RemotizerCPReached : cmd_cp_reached
+    }
+
     def process_ev(self, ev):
-        if isinstance(ev , rem488.RemotizerData):
+        ev_type = type(ev)
+        if ev_type is rem488.RemotizerData:
             len_params = len(ev.data)
             # Match receive data cmd
             if len_params > 0 and ev.sec_addr == 0:
@@ -537,25 +696,19 @@ class AmigoDriveState:
             elif ev.sec_addr == 0x10 and len_params == 1:
                 cmd = AmigoDriveState.cmd_amigo_clear
             else:
-                key_tuple = (ev.sec_addr , len_params , ev.data[ 0 ] if (len_params > 0) else None)
-                cmd = AmigoDriveState.LISTEN_CMDS.get(key_tuple, AmigoDriveState.cmd_unknown_listen)
-        elif isinstance(ev , rem488.RemotizerTalk):
+                key = (len_params << 13) | (ev.sec_addr << 8) | (ev.data[ 0 ] if len_params > 0 else 0)
+                cmd = AmigoDriveState.LISTEN_CMDS_INT.get(key, AmigoDriveState.cmd_unknown_listen)
+        elif ev_type is rem488.RemotizerTalk:
             cmd = AmigoDriveState.TALK_CMDS.get(ev.sec_addr, AmigoDriveState.cmd_unknown_talk)
-        elif isinstance(ev , rem488.RemotizerIdentify):
-            cmd = AmigoDriveState.cmd_identify
-        elif isinstance(ev , rem488.RemotizerAddressed):
-            cmd = AmigoDriveState.cmd_parallel_poll
-        elif isinstance(ev , rem488.RemotizerDevClear):
-            cmd = AmigoDriveState.cmd_dev_clear
-        elif isinstance(ev , rem488.RemotizerCPReached):
-            cmd = AmigoDriveState.cmd_cp_reached
         else:
+            cmd = AmigoDriveState.EV_CMDS.get(ev_type)
+            if cmd is not None:
+                cmd(self, ev)
             return
-        is_tl_cmd = isinstance(ev , rem488.RemotizerData) or isinstance(ev , rem488.RemotizerTalk)
-        if is_tl_cmd:
-            self.pp_enabled = True
+        self.pp_enabled = True
         cmd(self, ev)
-        if is_tl_cmd:
+        # set_pp(True) is a no-op unless PP state differs from pp_enabled
+        if self.pp_enabled != self.pp_state:
             self.set_pp(True)
 
 class SS80BaseUnitState:
@@ -576,13 +729,13 @@ class SS80BaseUnitState:
         pass
 
     def clear_status(self):
-        self.status_bits = bytearray(8)
+        self.status_bits = 0
         self.parameter = bytearray(10)
         self.qstat = 0
 
     def clear_status_mask(self):
         self.clear_status()
-        self.mask_bits = bytearray(8)
+        self.mask_bits = 0
         self.target_length = 0xffff_ffff
 
     def clear_unit(self):
@@ -592,7 +745,7 @@ class SS80BaseUnitState:
             self.qstat = 1
         else:
             self.clear_status()
-        self.mask_bits = bytearray(8)
+        self.mask_bits = 0
         self.target_length = 0xffff_ffff
         self.dec_state = 10
 
@@ -600,24 +753,22 @@ class SS80BaseUnitState:
         self.clear_status_bit(10)
         self.clear_status_bit(12)
         if self.qstat != 2:
-            if any(self.status_bits):
+            if self.status_bits != 0:
                 self.qstat = 1
             else:
                 self.qstat = 0
         self.dec_state = 11
 
-    def mask_idx(self, bit_no):
-        return bit_no // 8, 0x80 >> (bit_no % 8)
+    # Status & mask bits are kept in 64-bit ints, bit 0 being the MSB
+    BIT_MASKS = tuple(1 << (63 - n) for n in range(64))
 
     def test_bit(self, bits, bit_no):
-        idx, mask = self.mask_idx(bit_no)
-        return (bits[ idx ] & mask) != 0
+        return (bits & SS80BaseUnitState.BIT_MASKS[ bit_no ]) != 0
 
     def set_status_bit(self, bit_no):
         if not self.test_bit(self.mask_bits, bit_no) and\
-           (bit_no != 10 or not any(self.status_bits[ 0:6 ])):
-                idx, mask = self.mask_idx(bit_no)
-                self.status_bits[ idx ] |= mask
+           (bit_no != 10 or (self.status_bits & 0xffff_ffff_ffff_0000) == 0):
+                self.status_bits |= SS80BaseUnitState.BIT_MASKS[ bit_no ]
                 if bit_no == 30:
                     self.qstat = 2
                     self.holdoff = True
@@ -626,16 +777,17 @@ class SS80BaseUnitState:
         self.dec_state = 11
 
     def clear_status_bit(self, bit_no):
-        idx, mask = self.mask_idx(bit_no)
-        self.status_bits[ idx ] &= ~mask
+        self.status_bits &= ~SS80BaseUnitState.BIT_MASKS[ bit_no ]
 
 class SS80UnitState(SS80BaseUnitState):
     def __init__(self, geometry, unit_desc, vol_il):
         super().__init__()
         self.geometry = geometry
+        self.max_lba = geometry.max_lba
         self.unit_desc = unit_desc
-        self.bps = struct.unpack(">H", unit_desc[ 4:6 ])[ 0 ]
+        self.bps = int.from_bytes(unit_desc[ 4:6 ], "big")
         self.vol_il = vol_il
+        self.rd_buf = bytearray(self.bps)
         # AKA target address
         self.current_lba = 0
         self.rd_counter = 0
@@ -652,7 +804,7 @@ class SS80UnitState(SS80BaseUnitState):
         try:
             self.rd_counter = 0
             self.wr_counter = 0
-            self.image = open(image_file , "rb" if self.read_only else "r+b")
+            self.image = ImageFile(image_file , self.read_only , self.geometry.max_lba * self.bps)
             if not self.test_bit(self.status_bits, 30):
                 self.new = True
             return 0
@@ -675,23 +827,34 @@ class SS80UnitState(SS80BaseUnitState):
         return self.image is not None
 
     def write_img(self, data):
-        if self.is_ready() and not self.read_only:
-            self.image.seek(self.bps * self.current_lba)
-            self.image.write(data)
-            self.current_lba += 1
-            if self.current_lba == self.geometry.max_lba:
-                self.current_lba = 0
+        image = self.image
+        if image is not None and not self.read_only:
+            lba = self.current_lba
+            image.write(self.bps * lba , data)
+            lba += 1
+            self.current_lba = 0 if lba == self.max_lba else lba
             self.wr_counter += 1
 
+    def write_sectors(self, data, n):
+        image = self.image
+        if image is not None and not self.read_only:
+            lba = self.current_lba
+            image.write(self.bps * lba , data)
+            lba += n
+            self.current_lba = 0 if lba == self.max_lba else lba
+            self.wr_counter += n
+
     def read_img(self):
-        if self.is_ready():
-            self.image.seek(self.bps * self.current_lba)
-            data = bytearray(self.image.read(self.bps))
-            if len(data) < self.bps:
-                data.extend(bytes(self.bps - len(data)))
-            self.current_lba += 1
-            if self.current_lba == self.geometry.max_lba:
-                self.current_lba = 0
+        image = self.image
+        if image is not None:
+            data = self.rd_buf
+            bps = self.bps
+            lba = self.current_lba
+            n = image.readinto(bps * lba , data)
+            if n < bps:
+                data[ n: ] = bytes(bps - n)
+            lba += 1
+            self.current_lba = 0 if lba == self.max_lba else lba
             self.rd_counter += 1
         else:
             # Should never get here
@@ -699,10 +862,7 @@ class SS80UnitState(SS80BaseUnitState):
         return data
 
     def format_img(self):
-        self.image.seek(0)
-        fill = bytes(self.bps)
-        for x in range(self.geometry.max_lba):
-            self.image.write(fill)
+        self.image.fill(self.bps * self.geometry.max_lba , 0)
         self.wr_counter += self.geometry.max_lba
 
 class SS80DriveState:
@@ -712,6 +872,9 @@ class SS80DriveState:
         self.fixed_data = fixed_data
         self.units = [ SS80UnitState(u.geometry, u.unit_desc, u.vol_il) for u in fixed_data.unit_specs ]
         self.n_units = len(self.units)
+        # Indexes of units other than the active one that may have changed
+        self.dirty_units = set()
+        self.c_unit_no = 0
         self.unit15 = SS80BaseUnitState()
         self.srq_enabled = False
         self.unit15.clear_status_mask()
@@ -730,6 +893,7 @@ class SS80DriveState:
         for u in self.units:
             u.clear_unit()
             u.current_lba = 0
+        self.dirty_units.update(range(self.n_units))
         self.select_unit(0)
 
     def set_pp(self, new_pp_state):
@@ -754,13 +918,15 @@ class SS80DriveState:
 
     def select_unit(self, u):
         if u == 15:
-            self.c_unit = self.unit15
-            self.c_unit_no = 15
+            unit = self.unit15
         elif u < self.n_units:
-            self.c_unit = self.units[ u ]
-            self.c_unit_no = u
+            unit = self.units[ u ]
         else:
             raise self.Error(6)
+        if u != self.c_unit_no:
+            self.dirty_units.add(self.c_unit_no)
+        self.c_unit = unit
+        self.c_unit_no = u
 
     def check_listen_data(self, ev):
         if len(ev.data) > 50 or not ev.end:
@@ -770,30 +936,21 @@ class SS80DriveState:
         if self.c_unit is self.unit15:
             raise self.Error(5)
 
-    def collect_bytes(self, gen, n):
-        res = bytearray()
-        try:
-            for x in range(n):
-                res.append(next(gen))
-            return res
-        except StopIteration:
+    # Decoders scan "buf" (data of a listen event) starting at index "i"
+    def check_avail(self, buf, i, n):
+        # At least "n" more bytes are needed
+        if len(buf) - i < n:
             raise self.Error(9)
 
-    def check_end_seq(self, gen, n):
-        if n > 0:
-            res = self.collect_bytes(gen, n)
-        else:
-            res = None
-        try:
-            # This "next" should fail (sequence should stop here)
-            b = next(gen)
-        except StopIteration:
-            return res
-        raise self.Error(9)
+    def check_end_seq(self, buf, i, n):
+        # Sequence should stop after "n" more bytes
+        if len(buf) - i != n:
+            raise self.Error(9)
 
-    def not_unit15_end_seq(self, gen, n):
+    def not_unit15_end_seq(self, buf, i, n):
         self.check_not_unit15()
-        return self.check_end_seq(gen, n)
+        if len(buf) - i != n:
+            raise self.Error(9)
 
     def check_new_not_ready(self):
         if not self.c_unit.is_ready():
@@ -808,13 +965,13 @@ class SS80DriveState:
         if self.c_unit.read_only:
             raise self.Error(36)
 
-    def dec_cmd_locate_read(self, gen):
-        self.not_unit15_end_seq(gen, 0)
+    def dec_cmd_locate_read(self, buf, i):
+        self.not_unit15_end_seq(buf, i, 0)
         self.check_new_not_ready()
         self.c_unit.dec_state = 11 if self.c_unit.target_length == 0 else 1
 
-    def dec_cmd_locate_write(self, gen):
-        self.not_unit15_end_seq(gen, 0)
+    def dec_cmd_locate_write(self, buf, i):
+        self.not_unit15_end_seq(buf, i, 0)
         self.check_new_not_ready()
         self.check_not_read_only()
         if self.c_unit.target_length != 0:
@@ -830,10 +987,26 @@ class SS80DriveState:
             self.c_unit.first_0e = False
             self.check_new_not_ready()
             self.check_not_read_only()
-        self.c_unit.accum_0e.extend(ev.data)
-        mv = memoryview(self.c_unit.accum_0e)
+        # Incoming data is used in place unless a partial sector is pending
+        accum = self.c_unit.accum_0e
+        if accum:
+            accum.extend(ev.data)
+            mv = memoryview(accum)
+        else:
+            mv = memoryview(ev.data)
         idx = 0
         rem = len(mv)
+        unit = self.c_unit
+        bps = unit.bps
+        if unit.is_ready() and not unit.read_only:
+            # Write in one go all full sectors that neither end the transfer nor wrap around
+            n = min(rem // bps , (self.len_op - 1) // bps , unit.max_lba - unit.current_lba - 1)
+            if n > 0:
+                taken = n * bps
+                unit.write_sectors(mv[ :taken ] , n)
+                idx = taken
+                rem -= taken
+                self.len_op -= taken
         while True:
             if self.len_op > self.c_unit.bps:
                 min_len = self.c_unit.bps
@@ -842,8 +1015,7 @@ class SS80DriveState:
                 min_len = self.len_op
                 exp_end = True
             if not ev.end and not ev.unlistened and rem < min_len:
-                if idx > 0:
-                    self.c_unit.accum_0e = self.c_unit.accum_0e[ idx: ]
+                self.c_unit.accum_0e = bytearray(mv[ idx: ])
                 self.pp_enabled = False
                 break
             taken = min(rem, self.c_unit.bps)
@@ -855,9 +1027,9 @@ class SS80DriveState:
             if taken == self.c_unit.bps:
                 self.c_unit.write_img(mv[ idx:(idx+taken) ])
             else:
-                data = bytearray(mv[ idx: ])
-                fill = bytearray(self.c_unit.bps - taken)
-                data.extend(fill)
+                # Short sector: zero-padded
+                data = bytearray(self.c_unit.bps)
+                data[ :taken ] = mv[ idx: ]
                 self.c_unit.write_img(data)
             idx += taken
             rem -= taken
@@ -873,8 +1045,8 @@ class SS80DriveState:
             else:
                 self.len_op -= self.c_unit.bps
 
-    def dec_cmd_locate_verify(self, gen):
-        self.not_unit15_end_seq(gen, 0)
+    def dec_cmd_locate_verify(self, buf, i):
+        self.not_unit15_end_seq(buf, i, 0)
         self.check_new_not_ready()
         if self.c_unit.target_length == 0xffff_ffff:
             self.c_unit.current_lba = 0
@@ -889,43 +1061,24 @@ class SS80DriveState:
                 raise self.Error(44)
         self.c_unit.dec_state = 11
 
-    def dec_cmd_spare_block(self, gen):
-        dummy = self.not_unit15_end_seq(gen, 1)
+    def dec_cmd_spare_block(self, buf, i):
+        self.not_unit15_end_seq(buf, i, 1)
         self.check_new_not_ready()
         raise self.Error(34)
 
-    def dec_cmd_request_status(self, gen):
-        self.check_end_seq(gen, 0)
+    def dec_cmd_request_status(self, buf, i):
+        self.check_end_seq(buf, i, 0)
         # In real hw errors 17, 24, 41, 58, 59 would be checked here (these errors
         # have something that's not current target address in parameter field)
-        self.c_unit.parameter[ 0 ] = 0
-        self.c_unit.parameter[ 1 ] = 0
         addr = 0 if self.c_unit is self.unit15 else self.c_unit.current_lba
-        self.c_unit.parameter[ 2:6 ] = struct.pack(">L", addr)
+        STRUCT_PARAM.pack_into(self.c_unit.parameter, 0, 0, addr)
         self.c_unit.dec_state = 5
 
-    def dec_cmd_release(self, gen):
-        self.check_end_seq(gen, 0)
-
-    def dec_cmd_release_denied(self, gen):
-        self.check_end_seq(gen, 0)
-
-    CMDS = {
-        0x00: dec_cmd_locate_read,
-        0x02: dec_cmd_locate_write,
-        0x04: dec_cmd_locate_verify,
-        0x06: dec_cmd_spare_block,
-        0x0d: dec_cmd_request_status,
-        0x0e: dec_cmd_release,
-        0x0f: dec_cmd_release_denied
-    }
+    def dec_cmd_release(self, buf, i):
+        self.check_end_seq(buf, i, 0)
 
-    def decode_cmd_0x(self, gen, b):
-        fn = self.CMDS.get(b)
-        if fn:
-            fn(self, gen)
-        else:
-            raise self.Error(5)
+    def dec_cmd_release_denied(self, buf, i):
+        self.check_end_seq(buf, i, 0)
 
     def cmd_validate_key(self, ev):
         self.check_new_not_ready()
@@ -938,143 +1091,189 @@ class SS80DriveState:
     def cmd_set_format_options(self, ev):
         raise self.Error(8)
 
-    def decode_cmd_3x(self, gen, b):
-        if b == 0x31:
-            cmd = self.collect_bytes(gen, 2)
-            if cmd[ 0 ] == 0xf1 and cmd[ 1 ] == 0x02:
-                # VALIDATE KEY
-                self.not_unit15_end_seq(gen, 0)
-                self.check_new_not_ready()
-                self.c_unit.dec_state = 8
-            elif cmd[ 0 ] == 0xf3 and cmd[ 1 ] == 0x5f:
-                # SET FORMAT OPTIONS
-                self.not_unit15_end_seq(gen, 0)
-                self.c_unit.dec_state = 9
-            else:
-                raise self.Error(8)
-        elif b == 0x33:
-            # INITIATE DIAGNOSTIC
-            code = self.check_end_seq(gen, 3)
-            if code[ 0 ] != 0 or code[ 1 ] != 1 or code[ 2 ] != 0:
-                raise self.Error(8)
-            self.c_unit.dec_state = 11
-        elif b == 0x35:
-            # DESCRIBE
-            self.check_end_seq(gen, 0)
-            self.c_unit.dec_state = 3
-        elif b == 0x37:
-            # INITIALIZE MEDIA
-            params = self.not_unit15_end_seq(gen, 2)
-            try:
-                self.check_new_not_ready()
-                self.check_not_read_only()
-                self.c_unit.format_img()
-            finally:
-                self.c_unit.dec_state = 11
+    def dec_cmd_utility(self, buf, i):
+        self.check_avail(buf, i, 2)
+        cmd = buf[ i ]
+        sub_cmd = buf[ i + 1 ]
+        if cmd == 0xf1 and sub_cmd == 0x02:
+            # VALIDATE KEY
+            self.not_unit15_end_seq(buf, i + 2, 0)
+            self.check_new_not_ready()
+            self.c_unit.dec_state = 8
+        elif cmd == 0xf3 and sub_cmd == 0x5f:
+            # SET FORMAT OPTIONS
+            self.not_unit15_end_seq(buf, i + 2, 0)
+            self.c_unit.dec_state = 9
         else:
-            raise self.Error(5)
+            raise self.Error(8)
+
+    def dec_cmd_initiate_diag(self, buf, i):
+        self.check_end_seq(buf, i, 3)
+        if buf[ i: ] != b"\x00\x01\x00":
+            raise self.Error(8)
+        self.c_unit.dec_state = 11
+
+    def dec_cmd_describe(self, buf, i):
+        self.check_end_seq(buf, i, 0)
+        self.c_unit.dec_state = 3
+
+    def dec_cmd_initialize_media(self, buf, i):
+        self.not_unit15_end_seq(buf, i, 2)
+        try:
+            self.check_new_not_ready()
+            self.check_not_read_only()
+            self.c_unit.format_img()
+        finally:
+            self.c_unit.dec_state = 11
+
+    # Command decoding table
+    # Opcode is key
+    CMDS = {
+        0x00: dec_cmd_locate_read,
+        0x02: dec_cmd_locate_write,
+        0x04: dec_cmd_locate_verify,
+        0x06: dec_cmd_spare_block,
+        0x0d: dec_cmd_request_status,
+        0x0e: dec_cmd_release,
+        0x0f: dec_cmd_release_denied,
+        0x31: dec_cmd_utility,
+        0x33: dec_cmd_initiate_diag,
+        0x35: dec_cmd_describe,
+        0x37: dec_cmd_initialize_media
+    }
 
     def listen_05(self, ev):
-        d = iter(ev.data)
+        buf = ev.data
+        i = 0
+        # Running past the end of buf (IndexError) ends the sequence
         try:
-            b = next(d)
+            b = buf[ i ]
+            i += 1
             if b == 0x34:
                 # 34: NOP
-                b = next(d)
+                b = buf[ i ]
+                i += 1
             if (b & 0xf0) == 0x20:
                 # 2x: select unit x
                 self.select_unit(b & 0x0f)
-                b = next(d)
-            if self.c_unit.qstat == 2 and self.c_unit.holdoff:
-                raise StopIteration()
-            if self.c_unit.dec_state != 10:
+                b = buf[ i ]
+                i += 1
+            c_unit = self.c_unit
+            if c_unit.qstat == 2 and c_unit.holdoff:
+                c_unit.dec_state = 11
+                return
+            if c_unit.dec_state != 10:
                 raise self.Error(10)
-            for i in range(8):
+            for x in range(8):
                 if b == 0x34:
                     # 34: NOP
-                    b = next(d)
+                    b = buf[ i ]
+                    i += 1
                 if (b & 0xf8) == 0x40:
                     # 4x: volume
                     if b != 0x40:
                         raise self.Error(6)
                     else:
-                        b = next(d)
+                        b = buf[ i ]
+                        i += 1
                 if b == 0x34:
-                    b = next(d)
+                    b = buf[ i ]
+                    i += 1
                 if b == 0x10:
                     # 10: set address
                     self.check_not_unit15()
-                    addr = self.collect_bytes(d, 6)
-                    if addr[ 0 ] != 0 or addr[ 1 ] != 0:
+                    self.check_avail(buf, i, 6)
+                    if buf[ i ] != 0 or buf[ i + 1 ] != 0:
                         raise self.Error(7)
-                    dec_addr = struct.unpack(">L", addr[ 2:6 ])[ 0 ]
-                    if dec_addr >= self.c_unit.geometry.max_lba:
+                    dec_addr = STRUCT_U32.unpack_from(buf, i + 2)[ 0 ]
+                    i += 6
+                    if dec_addr >= c_unit.geometry.max_lba:
                         raise self.Error(7)
-                    self.c_unit.current_lba = dec_addr
-                    b = next(d)
+                    c_unit.current_lba = dec_addr
+                    b = buf[ i ]
+                    i += 1
                 if b == 0x34:
-                    b = next(d)
+                    b = buf[ i ]
+                    i += 1
                 if b == 0x18:
                     # 18: set length
-                    l = self.collect_bytes(d, 4)
-                    dec_l = struct.unpack(">L", l)[ 0 ]
-                    self.c_unit.target_length = dec_l
-                    b = next(d)
+                    self.check_avail(buf, i, 4)
+                    c_unit.target_length = STRUCT_U32.unpack_from(buf, i)[ 0 ]
+                    i += 4
+                    b = buf[ i ]
+                    i += 1
                 if b == 0x34:
-                    b = next(d)
+                    b = buf[ i ]
+                    i += 1
                 if (b & 0xf0) == 0x00:
-                    self.decode_cmd_0x(d, b)
-                    return
+                    break
                 if b == 0x39:
-                    dummy = self.collect_bytes(d, 2)
-                    b = next(d)
+                    self.check_avail(buf, i, 2)
+                    i += 2
+                    b = buf[ i ]
+                    i += 1
                 if b == 0x3b:
-                    dummy = self.collect_bytes(d, 1)
-                    b = next(d)
+                    self.check_avail(buf, i, 1)
+                    i += 1
+                    b = buf[ i ]
+                    i += 1
                 if b == 0x3e:
-                    mask = self.collect_bytes(d, 8)
-                    if mask[ 2 ] != 0 or mask[ 3 ] != 0:
+                    self.check_avail(buf, i, 8)
+                    if buf[ i + 2 ] != 0 or buf[ i + 3 ] != 0:
                         raise self.Error(8)
-                    self.c_unit.mask_bits = mask
-                    b = next(d)
+                    c_unit.mask_bits = STRUCT_U64.unpack_from(buf, i)[ 0 ]
+                    i += 8
+                    b = buf[ i ]
+                    i += 1
                 if b == 0x48:
-                    mode = self.collect_bytes(d, 1)
-                    if mode[ 0 ] != 0:
+                    self.check_avail(buf, i, 1)
+                    if buf[ i ] != 0:
                         raise self.Error(8)
-                    b = next(d)
-            if (b & 0xf0) == 0x00:
-                self.decode_cmd_0x(d, b)
-                return
-            if (b & 0xf0) == 0x30:
-                self.decode_cmd_3x(d, b)
-                return
-            raise self.Error(5)
-        except StopIteration:
+                    i += 1
+                    b = buf[ i ]
+                    i += 1
+        except IndexError:
             self.c_unit.dec_state = 11
+            return
+        fn = SS80DriveState.CMDS.get(b)
+        if fn is None:
+            raise self.Error(5)
+        fn(self, buf, i)
+
+    # Handlers of data listened on SA 0x0e
+    # dec_state is key
+    LISTEN_0E_CMDS = {
+        2: cmd_write,
+        8: cmd_validate_key,
+        9: cmd_set_format_options
+    }
 
     def listen_0e(self, ev):
-        if self.c_unit.dec_state == 2:
-            self.cmd_write(ev)
-        elif self.c_unit.dec_state == 8:
-            self.cmd_validate_key(ev)
-        elif self.c_unit.dec_state == 9:
-            self.cmd_set_format_options(ev)
-        else:
+        fn = SS80DriveState.LISTEN_0E_CMDS.get(self.c_unit.dec_state)
+        if fn is None:
             raise self.Error(10)
+        fn(self, ev)
+
+    # Write loopback pattern (0x00 ... 0xff), twice so that any 256-byte window can be sliced
+    LOOPBACK_EXPECT = bytes(range(256)) * 2
 
     def cmd_write_loopback(self, ev):
         # No EPPR!
         self.pp_enabled = False
-        if len(ev.data) > self.len_op:
-            raise self.Error(12)
-        if ev.end != (len(ev.data) == self.len_op):
+        n = len(ev.data)
+        end = ev.end
+        len_op = self.len_op
+        if n > len_op or end != (n == len_op):
             raise self.Error(12)
-        for idx, b in enumerate(ev.data, self.next_loop):
-            if b != (idx % 256):
+        mv = memoryview(ev.data)
+        start = self.next_loop
+        for pos in range(0, n, 256):
+            chunk = mv[ pos:pos + 256 ]
+            if chunk != SS80DriveState.LOOPBACK_EXPECT[ start:start + len(chunk) ]:
                 raise self.Error(2)
-        self.next_loop = (self.next_loop + len(ev.data)) % 256
-        self.len_op -= len(ev.data)
-        if ev.end:
+        self.next_loop = (start + n) % 256
+        self.len_op = len_op - n
+        if end:
             self.c_unit.dec_state = 10
 
     def cmd_ch_independent_clear(self):
@@ -1088,69 +1287,71 @@ class SS80DriveState:
         self.c_unit.cancel()
 
     def listen_12(self, ev):
-        d = iter(ev.data)
-        try:
-            b = next(d)
-            if (b & 0xf0) == 0x20:
-                # 2x: select unit x
-                self.select_unit(b & 0x0f)
-                b = next(d)
-                if b == 8:
-                    self.cmd_ch_independent_clear()
-                elif b == 9:
-                    self.cmd_cancel()
-                else:
-                    raise self.Error(5)
-            elif b == 0x01:
-                # 01: HPIB parity checking
-                # No EPPR
-                self.pp_enabled = False
-                param = self.collect_bytes(d, 1)
-                self.srq_enabled = (param[ 0 ] & 2) != 0
-            elif b == 0x02:
-                # 02: read loopback
-                # No EPPR
-                self.pp_enabled = False
-                l1 = self.check_end_seq(d, 4)
-                l2 = struct.unpack(">L", l1)[ 0 ]
-                if l2 == 0:
-                    raise self.Error(8)
-                self.len_op = l2
-                self.c_unit.dec_state = 6
-            elif b == 0x03:
-                # 03: write loopback
-                # No EPPR
-                self.pp_enabled = False
-                l1 = self.check_end_seq(d, 4)
-                l2 = struct.unpack(">L", l1)[ 0 ]
-                if l2 == 0:
-                    raise self.Error(8)
-                self.len_op = l2
-                self.next_loop = 0xff
-                self.c_unit.dec_state = 7
-            elif b == 0x08:
+        buf = ev.data
+        if len(buf) == 0:
+            raise self.Error(5)
+        b = buf[ 0 ]
+        if (b & 0xf0) == 0x20:
+            # 2x: select unit x
+            self.select_unit(b & 0x0f)
+            if len(buf) < 2:
+                raise self.Error(5)
+            b = buf[ 1 ]
+            if b == 8:
                 self.cmd_ch_independent_clear()
-            elif b == 0x09:
+            elif b == 9:
                 self.cmd_cancel()
             else:
-               raise self.Error(5)
-        except StopIteration:
+                raise self.Error(5)
+        elif b == 0x01:
+            # 01: HPIB parity checking
+            # No EPPR
+            self.pp_enabled = False
+            self.check_avail(buf, 1, 1)
+            self.srq_enabled = (buf[ 1 ] & 2) != 0
+        elif b == 0x02:
+            # 02: read loopback
+            # No EPPR
+            self.pp_enabled = False
+            self.check_end_seq(buf, 1, 4)
+            l2 = STRUCT_U32.unpack_from(buf, 1)[ 0 ]
+            if l2 == 0:
+                raise self.Error(8)
+            self.len_op = l2
+            self.c_unit.dec_state = 6
+        elif b == 0x03:
+            # 03: write loopback
+            # No EPPR
+            self.pp_enabled = False
+            self.check_end_seq(buf, 1, 4)
+            l2 = STRUCT_U32.unpack_from(buf, 1)[ 0 ]
+            if l2 == 0:
+                raise self.Error(8)
+            self.len_op = l2
+            self.next_loop = 0xff
+            self.c_unit.dec_state = 7
+        elif b == 0x08:
+            self.cmd_ch_independent_clear()
+        elif b == 0x09:
+            self.cmd_cancel()
+        else:
             raise self.Error(5)
 
     def process_listen(self, ev):
+        sa = ev.sec_addr
         try:
-            if ev.sec_addr == 0x05:
+            if sa == 0x05:
                 self.check_listen_data(ev)
                 self.listen_05(ev)
-            elif ev.sec_addr == 0x0e:
+            elif sa == 0x0e:
                 self.listen_0e(ev)
-            elif ev.sec_addr == 0x10:
+            elif sa == 0x10:
                 self.check_listen_data(ev)
                 if len(ev.data) != 1:
                     self.c_unit.set_status_bit(9)
                 # No EPPR!
                 self.pp_enabled = False
-            elif ev.sec_addr == 0x12:
+            elif sa == 0x12:
                 if self.c_unit.dec_state == 7:
                     self.cmd_write_loopback(ev)
                 else:
@@ -1187,7 +1388,7 @@ class SS80DriveState:
             reached_end = False
         if self.c_unit.target_length != 0xffff_ffff:
             if self.len_op <= self.c_unit.bps:
-                self.talk_and_set_cp(data[ :self.len_op ], True, SS80DriveState.generic_talk_cp)
+                self.talk_and_set_cp(memoryview(data)[ :self.len_op ], True, SS80DriveState.generic_talk_cp)
             else:
                 self.talk_and_set_cp(data, reached_end, SS80DriveState.cmd_read_cp3 if reached_end else SS80DriveState.cmd_read_cp2)
         else:
@@ -1214,27 +1415,38 @@ class SS80DriveState:
             # Reached end of volume
             self.c_unit.set_status_bit(44)
 
+    # Index of the unit the last command could have changed (15 = controller)
+    def active_unit(self):
+        return self.c_unit_no
+
     def cmd_describe(self):
         # First controller description
-        out = bytearray(self.fixed_data.cont_desc)
-        if self.c_unit is self.unit15:
-            for u in self.units:
-                self.describe_unit(u, out)
-        else:
-            self.describe_unit(self.c_unit, out)
+        # then description of selected unit (or all units)
+        units = self.units if self.c_unit is self.unit15 else [ self.c_unit ]
+        cont_desc = self.fixed_data.cont_desc
+        out = bytearray(len(cont_desc) + sum(len(u.unit_desc) + STRUCT_VOL.size for u in units))
+        off = len(cont_desc)
+        out[ :off ] = cont_desc
+        for u in units:
+            off = self.describe_unit(u, out, off)
         self.talk_and_set_cp(out, True, SS80DriveState.generic_talk_cp)
         self.pp_enabled = False
 
-    def describe_unit(self, unit, out):
-        out.extend(unit.unit_desc)
+    # Write description of "unit" into "out" at "off", return offset past it
+    def describe_unit(self, unit, out, off):
+        end = off + len(unit.unit_desc)
+        out[ off:end ] = unit.unit_desc
         c, h, s = unit.geometry.max_chs
-        vol = struct.pack(">xHBHxxLB", c - 1, h - 1, s - 1, unit.geometry.max_lba - 1 if unit.is_ready() else 0, unit.vol_il)
-        out.extend(vol)
+        STRUCT_VOL.pack_into(out, end, c - 1, h - 1, s - 1, unit.geometry.max_lba - 1 if unit.is_ready() else 0, unit.vol_il)
+        return end + STRUCT_VOL.size
 
     def cmd_request_status(self):
-        out = bytearray([ self.c_unit_no, 0xff ])
-        out.extend(self.c_unit.status_bits)
-        out.extend(self.c_unit.parameter)
+        unit = self.c_unit
+        out = bytearray(20)
+        out[ 0 ] = self.c_unit_no
+        out[ 1 ] = 0xff
+        STRUCT_U64.pack_into(out, 2, unit.status_bits)
+        out[ 10: ] = unit.parameter
         self.talk_and_set_cp(out, True, SS80DriveState.cmd_request_status_cp)
         self.pp_enabled = False
 
@@ -1259,21 +1471,24 @@ class SS80DriveState:
         # No EPPR!
         self.pp_enabled = False
 
+    # Read loopback pattern: 0xff, 0x00, 0x01 ... 0xfe
+    LOOPBACK_DATA = bytes((0xff ,)) + bytes(range(255))
+
     def cmd_read_loopback(self):
-        data = bytes([ (x + 0xff) & 0xff for x in range(256) ])
         l = min(self.len_op, 256)
         reached_end = l <= 256
-        self.talk_and_set_cp(data[ :l ], reached_end, SS80DriveState.cmd_read_loopback_cp2 if reached_end else SS80DriveState.cmd_read_loopback_cp1)
+        self.talk_and_set_cp(SS80DriveState.LOOPBACK_DATA[ :l ], reached_end, SS80DriveState.cmd_read_loopback_cp2 if reached_end else SS80DriveState.cmd_read_loopback_cp1)
         # No EPPR!
         self.pp_enabled = False
 
     def cmd_read_loopback_cp1(self, ev):
-        # No EPPR!
-        self.pp_enabled = False
         if ev.flushed:
             self.c_unit.set_status_bit(12)
+            # No EPPR!
+            self.pp_enabled = False
         else:
             self.len_op -= 256
+            # No EPPR (set by cmd_read_loopback)
             self.cmd_read_loopback()
 
     def cmd_read_loopback_cp2(self, ev):
@@ -1284,58 +1499,113 @@ class SS80DriveState:
         else:
             self.c_unit.dec_state = 10
 
+    # Handlers of talking on SA 0x0e
+    # dec_state is key
+    TALK_0E_CMDS = {
+        1: cmd_read,
+        3: cmd_describe,
+        5: cmd_request_status
+    }
+
     def process_talk(self, ev):
+        sa = ev.sec_addr
+        c_unit = self.c_unit
         try:
-            if ev.sec_addr == 0x0e:
-                if self.c_unit.dec_state == 1:
-                    self.cmd_read()
-                elif self.c_unit.dec_state == 3:
-                    self.cmd_describe()
-                elif self.c_unit.dec_state == 5:
-                    self.cmd_request_status()
+            if sa == 0x0e:
+                fn = SS80DriveState.TALK_0E_CMDS.get(c_unit.dec_state)
+                if fn is not None:
+                    fn(self)
                 else:
                     self.send_end_byte()
-                    self.c_unit.set_status_bit(10)
-            elif ev.sec_addr == 0x10:
+                    c_unit.set_status_bit(10)
+            elif sa == 0x10:
                 self.cmd_qstat()
-            elif ev.sec_addr == 0x12 and self.c_unit.dec_state == 6:
+            elif sa == 0x12 and c_unit.dec_state == 6:
                 self.cmd_read_loopback()
             else:
                 self.send_end_byte()
-                self.c_unit.set_status_bit(10)
+                c_unit.set_status_bit(10)
         except self.Error as e:
             self.c_unit.set_status_bit(e.err_no)
 
-    def process_ev(self, ev):
-        if isinstance(ev, rem488.RemotizerIdentify):
-            self.cmd_identify()
-        elif isinstance(ev, rem488.RemotizerAddressed):
-            self.cmd_parallel_poll(ev)
-        elif isinstance(ev, rem488.RemotizerData):
-            self.pp_enabled = True
-            self.process_listen(ev)
-            self.set_pp(True)
-        elif isinstance(ev, rem488.RemotizerTalk):
-            self.pp_enabled = True
-            self.process_talk(ev)
-            self.set_pp(True)
-        elif isinstance(ev, rem488.RemotizerCPReached) and self.cp_reached_handler is not None:
+    def ev_identify(self, ev):
+        self.cmd_identify()
+
+    def ev_cp_reached(self, ev):
+        if self.cp_reached_handler is not None:
             tmp = self.cp_reached_handler
             self.cp_reached_handler = None
             self.pp_enabled = True
             tmp(self, ev)
             self.set_pp(True)
-        elif isinstance(ev, rem488.RemotizerDevClear):
-            self.set_pp(False)
-            self.device_clear()
+
+    def ev_dev_clear(self, ev):
+        self.set_pp(False)
+        self.device_clear()
+        self.pp_enabled = True
+        self.set_pp(True)
+
+    # Handlers for events other than listen/talk
+    # Event type is key
+    EV_HANDLERS = {
+        rem488.RemotizerIdentify  : ev_identify,
+        rem488.RemotizerAddressed : cmd_parallel_poll,
+        rem488.RemotizerCPReached : ev_cp_reached,
+        rem488.RemotizerDevClear  : ev_dev_clear
+    }
+
+    def process_ev(self, ev):
+        ev_type = type(ev)
+        if ev_type is rem488.RemotizerData:
             self.pp_enabled = True
-            self.set_pp(True)
+            self.process_listen(ev)
+            # set_pp(True) is a no-op unless PP state differs from pp_enabled
+            if self.pp_enabled != self.pp_state:
+                self.set_pp(True)
+        elif ev_type is rem488.RemotizerTalk:
+            self.pp_enabled = True
+            self.process_talk(ev)
+            if self.pp_enabled != self.pp_state:
+                self.set_pp(True)
+        else:
+            handler = SS80DriveState.EV_HANDLERS.get(ev_type)
+            if handler is not None:
+                handler(self, ev)
 
 PROTOS = {
     "Amigo": AmigoDriveState,
     "SS/80": SS80DriveState
 }
 
+# Read/write counters & positions are reported to GUI at most once every 10 ms
+COUNTER_PERIOD = 0.01
+
+# Batched read/write counters of all units
+# rd & wr are lists of deltas, indexed by unit#
+class CounterEvent(QtCore.QEvent):
+    TYPE = QtCore.QEvent.Type(QtCore.QEvent.registerEventType())
+
+    def __init__(self , rd , wr):
+        QtCore.QEvent.__init__(self , self.TYPE)
+        self.rd = rd
+        self.wr = wr
+
+class ImageLoader(QtCore.QObject):
+    # Report outcome of image loading
+    # Params: unit# , status (0 or errno) , file name , model generation
+    load_status = QtCore.pyqtSignal(int , int , str , int)
+
+    def __init__(self , io):
+        QtCore.QObject.__init__(self)
+        self.io = io
+
+    # SLOT
+    def load(self , unit , image_file , model_gen):
+        status = self.io.load_image(unit , image_file , model_gen)
+        if status is None:
+            status = -1
+        self.load_status.emit(unit , status , image_file , model_gen)
+
 class IOThread(QtCore.QThread):
     # *****************
     # **** Signals ****
@@ -1344,13 +1614,16 @@ class IOThread(QtCore.QThread):
     # Report connection status
     # 1st parameter is one of rem488.CONNECTION_*
     status_connect = QtCore.pyqtSignal(int , str)
-    # Report Read counter
-    rd_counter = QtCore.pyqtSignal(int , int)
-    # Report Write counter
-    wr_counter = QtCore.pyqtSignal(int , int)
     # Report current position
     # Params: unit# , LBA , Cylinder , Head , Sector
     curr_pos = QtCore.pyqtSignal(int , int , int , int , int)
+    # Request loading of an image file (done in loader thread)
+    # Params: unit# , file name , model generation (see model_gen)
+    # Requests made before last model change are dropped
+    request_load = QtCore.pyqtSignal(int , str , int)
+    # Report outcome of image loading
+    # Params: unit# , status (0 or errno) , file name , model generation
+    load_status = QtCore.pyqtSignal(int , int , str , int)
 
     def __init__(self, port):
         QtCore.QThread.__init__(self)
@@ -1358,25 +1631,111 @@ class IOThread(QtCore.QThread):
         self.rem = rem488.RemotizerIO(port , True)
         self.model_index = -1
         self.drive = None
+        # Bumped each time drive is replaced
+        self.model_gen = 0
+        self.current_lba = []
+        self.rd_acc = []
+        self.wr_acc = []
+        # Read/write counters are posted to this object as CounterEvent's
+        self.counter_receiver = None
+        # Opening & mapping image files is done in its own thread
+        self.loader_thread = QtCore.QThread()
+        self.loader = ImageLoader(self)
+        self.loader.moveToThread(self.loader_thread)
+        self.request_load.connect(self.loader.load , QtCore.Qt.ConnectionType.QueuedConnection)
+        self.loader.load_status.connect(self.load_status)
+        self.loader_thread.start()
+        self.stop_req = False
 
     def run(self):
-        while True:
-            ev = self.rem.get_event()
-            if isinstance(ev , rem488.RemotizerConnection):
-                self.status_connect.emit(ev.status , ev.msg)
-            elif self.drive:
-                self.drive.process_ev(ev)
-                for unit_no , unit in enumerate(self.drive.units):
-                    if unit.rd_counter:
-                        self.rd_counter.emit(unit_no , unit.rd_counter)
-                        unit.rd_counter = 0
-                    if unit.wr_counter:
-                        self.wr_counter.emit(unit_no , unit.wr_counter)
-                        unit.wr_counter = 0
-                    if self.current_lba[ unit_no ] != unit.current_lba:
-                        self.current_lba[ unit_no ] = unit.current_lba
-                        c , h , s = unit.get_current_chs()
-                        self.curr_pos.emit(unit_no , unit.current_lba , c , h , s)
+        pending = False
+        monotonic = time.monotonic
+        last_post = monotonic()
+        get_event = self.rem.get_event
+        connection_type = rem488.RemotizerConnection
+        lock = self.lock
+        gen = None
+        while not self.stop_req:
+            # Wake up in time to post pending counters when link is idle
+            ev = get_event(COUNTER_PERIOD if pending else None)
+            # Drive & images are not replaced by other threads while an event is processed
+            with lock:
+                if gen != self.model_gen:
+                    # Drive was replaced: re-bind locals
+                    gen = self.model_gen
+                    drive = self.drive
+                    process_ev = drive.process_ev if drive else None
+                    active_unit = drive.active_unit if drive else None
+                    units = list(enumerate(drive.units)) if drive else []
+                    # Usually only the active unit needs checking
+                    one_unit = [ [ u ] for u in units ]
+                    dirty_units = drive.dirty_units if drive else None
+                    rd_acc = self.rd_acc
+                    wr_acc = self.wr_acc
+                    current_lba = self.current_lba
+                if type(ev) is connection_type:
+                    self.status_connect.emit(ev.status , ev.msg)
+                elif ev is not None and process_ev:
+                    process_ev(ev)
+                    unit_no = active_unit()
+                    if dirty_units:
+                        # Units left behind by a unit switch or changed by a global command
+                        dirty_units.add(unit_no)
+                        check = [ units[ u ] for u in dirty_units if u < len(units) ]
+                        dirty_units.clear()
+                    else:
+                        check = one_unit[ unit_no ] if unit_no < len(one_unit) else ()
+                    for unit_no , unit in check:
+                        n = unit.rd_counter
+                        if n:
+                            rd_acc[ unit_no ] += n
+                            unit.rd_counter = 0
+                            pending = True
+                        n = unit.wr_counter
+                        if n:
+                            wr_acc[ unit_no ] += n
+                            unit.wr_counter = 0
+                            pending = True
+                        if current_lba[ unit_no ] != unit.current_lba:
+                            pending = True
+                if pending:
+                    now = monotonic()
+                    if ev is None or now - last_post >= COUNTER_PERIOD:
+                        self.post_updates()
+                        pending = False
+                        last_post = now
+
+    # Post counters & report positions that changed
+    # Accumulators are cleared in place, so run() can keep them in locals
+    def post_updates(self):
+        rd_acc = self.rd_acc
+        wr_acc = self.wr_acc
+        if any(rd_acc) or any(wr_acc):
+            if self.counter_receiver is not None:
+                QtCore.QCoreApplication.postEvent(self.counter_receiver , CounterEvent(rd_acc[ : ] , wr_acc[ : ]))
+            rd_acc[ : ] = [ 0 ] * len(rd_acc)
+            wr_acc[ : ] = [ 0 ] * len(wr_acc)
+        drive = self.drive
+        if drive:
+            current_lba = self.current_lba
+            for unit_no , unit in enumerate(drive.units):
+                lba = unit.current_lba
+                if current_lba[ unit_no ] != lba:
+                    current_lba[ unit_no ] = lba
+                    c , h , s = unit.get_current_chs()
+                    self.curr_pos.emit(unit_no , lba , c , h , s)
+
+    # Stop this thread & the loader thread (a load in progress is completed)
+    def stop(self):
+        self.stop_req = True
+        self.rem.wake_up()
+        self.wait()
+        self.loader_thread.quit()
+        self.loader_thread.wait()
+
+    # Set receiver of CounterEvent's
+    def set_counter_receiver(self , obj):
+        self.counter_receiver = obj
 
     # Set model (by index into DRIVE_MODELS)
     def set_model(self , index):
@@ -1390,11 +1749,17 @@ class IOThread(QtCore.QThread):
                     fixed_data = DRIVE_MODELS[ index ]
                     self.drive = PROTOS[ fixed_data.protocol ](self.rem , fixed_data)
                     self.current_lba = [ 0 ] * self.drive.n_units
+                    self.rd_acc = [ 0 ] * self.drive.n_units
+                    self.wr_acc = [ 0 ] * self.drive.n_units
+                    self.model_gen += 1
 
     # Load/unload an image file
-    def load_image(self , unit , image_file):
+    # Loading is skipped (None is returned) when model_gen is given and drive was replaced since
+    def load_image(self , unit , image_file , model_gen = None):
         if self.drive:
             with self.lock:
+                if model_gen is not None and model_gen != self.model_gen:
+                    return None
                 if image_file:
                     return self.drive.units[ unit ].load_image(image_file)
                 else:
@@ -21,7 +21,8 @@
 
 import threading
 import socket
-import collections
+import re
+import queue
 import socketserver
 
 class RemotizerEvent:
@@ -132,6 +133,58 @@ class RemotizerSPAS(RemotizerEvent):
     def __str__(self):
         return "SPAS={}".format(self.enabled)
 
+# Size of socket send/receive buffers
+SOCK_BUF_SIZE = 1 << 20
+# Note on socket buffers for command line help
+SOCK_BUF_HELP = "Socket buffers are set to {} KiB, the kernel caps them at net.core.rmem_max/net.core.wmem_max.".format(SOCK_BUF_SIZE // 1024)
+# Size of buffer for receiving from socket
+RECV_BUF_SIZE = 1 << 16
+# Length of queue of pending connections
+LISTEN_BACKLOG = 16
+# Length of TCP Fast Open queue
+TFO_QUEUE_LEN = 5
+
+# TCP_QUICKACK option (not available on every platform)
+TCP_QUICKACK = getattr(socket , "TCP_QUICKACK" , None)
+
+def set_tcp_opt(sock , opt_name , value):
+    # Set a TCP option that is not available on every platform
+    opt = getattr(socket , opt_name , None)
+    if opt is not None:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP , opt , value)
+        except OSError:
+            pass
+
+# Quick ACK mode is not sticky: the kernel drops it again when it sees
+# interactive traffic. Receive loops re-arm it after a short read, i.e. when
+# the socket has been drained and the remote end is about to wait on our
+# ACKs (delayed ACKs would cost it up to 40 ms). Full reads mean more data
+# is already queued, so no syscall is spent on them.
+# Return False when quick ACK is not supported (no need to try again)
+def rearm_quickack(sock):
+    if TCP_QUICKACK is None:
+        return False
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP , TCP_QUICKACK , 1)
+        return True
+    except OSError:
+        return False
+
+# Bytes that str.isspace() accepts
+BLANK_BYTES = bytes(b for b in range(256) if chr(b).isspace())
+
+# Value of each 2-digit hex string (either case)
+HEX_DIGITS = "0123456789abcdefABCDEF"
+HEX_BYTES = { (h + l).encode("ascii") : int(h + l , 16) for h in HEX_DIGITS for l in HEX_DIGITS }
+
+# Encoded DAB & END messages for each byte value
+DAB_MSGS = tuple(b"D:%02x," % i for i in range(256))
+END_MSGS = tuple(b"E:%02x," % i for i in range(256))
+
+# Parity of each byte (1 = odd)
+PARITY = bytes(bin(i).count("1") & 1 for i in range(256))
+
 # Debug masks
 DBG_ENQUEUED = 1
 DBG_CMD = 2
@@ -144,9 +197,7 @@ class RemotizerIO:
     def _enqueue(self , obj):
         if self.debug and self.debug_mask & DBG_ENQUEUED:
             print("Q:{}".format(str(obj)) , file = self.debug)
-        with self.cv:
-            self.q.append(obj)
-            self.cv.notify()
+        self.q.put(obj)
 
     def _init_488(self):
         # 0: idle
@@ -195,10 +246,7 @@ class RemotizerIO:
 
     def _print_cmd(self , byte , out):
         code = byte & 0x7f
-        parity = (byte >> 4) ^ (byte & 0x0f)
-        parity = (parity >> 2) ^ (parity & 0x03)
-        parity = (parity >> 1) ^ (parity & 0x01)
-        par_msg = "(E)" if parity == 0 else "(O)"
+        par_msg = "(O)" if PARITY[ byte ] else "(E)"
         if code in self.CMDS:
             s = self.CMDS[ code ]
         elif (code & 0x60) == 0x20:
@@ -263,95 +311,123 @@ class RemotizerIO:
             self.listen_data = False
         self.listen_sa = None
 
+    def _cmd_nop(self , msg_data):
+        pass
+
+    def _cmd_dcl(self , msg_data):
+        # Device Clear
+        self._enqueue(RemotizerDevClear())
+
+    def _cmd_sdc(self , msg_data):
+        # Selected Device Clear
+        if self.hpib_state == 2:
+            self._enqueue(RemotizerDevClear())
+
+    def _cmd_ppc(self , msg_data):
+        # PPC
+        if self.hpib_state == 2:
+            self.sa_state = 1
+
+    def _cmd_spe(self , msg_data):
+        # SPE
+        self.spms = True
+
+    def _cmd_spd(self , msg_data):
+        # SPD
+        self.spms = False
+
+    def _cmd_mla(self , msg_data):
+        # MLA
+        self._unlistened()
+        # -> LADS
+        self.hpib_state = 2
+        # -> LPAS
+        self.sa_state = 3
+        self.next_event = None
+        if not self.has_sa:
+            self._set_addressed(True)
+
+    def _cmd_unl(self , msg_data):
+        # UNL
+        if self.hpib_state == 2:
+            # -> idle
+            self.hpib_state = 0
+            self._unlistened()
+            self._set_addressed(False)
+
+    def _cmd_mta(self , msg_data):
+        # MTA
+        self._unlistened()
+        # -> TADS
+        self.hpib_state = 1
+        # -> TPAS
+        self.sa_state = 2
+        self.next_event = RemotizerTalk(None)
+        if not self.has_sa:
+            self._set_addressed(True)
+
+    def _cmd_ota(self , msg_data):
+        # OTA or UNT
+        if self.hpib_state == 1:
+            self.hpib_state = 0
+            self.next_event = None
+            self._set_addressed(False)
+        if msg_data == 0x5f:
+            # -> UNT
+            self.sa_state = 4
+
+    def _cmd_sa(self , msg_data):
+        # Secondary address
+        if self.sa_state == 1:
+            # PPE / PPD
+            # TODO:
+            pass
+        elif self.sa_state == 2:
+            # MTA + SA
+            self.next_event = RemotizerTalk(msg_data & 0x1f)
+            self._set_addressed(True)
+        elif self.sa_state == 3:
+            # MLA + SA
+            self.listen_sa = msg_data & 0x1f
+            self._set_addressed(True)
+        elif self.sa_state == 4 and msg_data == self.msa:
+            # UNT + SA
+            self.next_event = RemotizerIdentify()
+
+    # Handlers of command bytes that don't depend on bus address
+    # Command byte is key
+    # Commands not implemented:
+    # 01        Go To Local
+    # 08        Group Execute Trigger
+    # 09        Take Control
+    # 11        Local Lock-Out
+    # 15        PPU (TODO)
+    # 1f        CFE
+    FIXED_CMD_FNS = {
+        0x04 : _cmd_sdc,
+        0x05 : _cmd_ppc,
+        0x14 : _cmd_dcl,
+        0x18 : _cmd_spe,
+        0x19 : _cmd_spd,
+        0x3f : _cmd_unl
+    }
+
     def _fsm488_D(self , msg_data):
         if (self.signals & 1) == 0:
             # Command byte (ATN is asserted)
             if self.debug and self.debug_mask & DBG_CMD:
                 self._print_cmd(msg_data , self.debug)
             msg_data &= 0x7f
-            is_pcg = (msg_data & 0x60) != 0x60
-            # Commands not implemented:
-            # 01        Go To Local
-            # 08        Group Execute Trigger
-            # 09        Take Control
-            # 11        Local Lock-Out
-            # 1f        CFE
-            if is_pcg:
+            if (msg_data & 0x60) != 0x60:
+                # Primary command group
                 self.sa_state = 0
-
-            if (msg_data == 0x04 and self.hpib_state == 2) or msg_data == 0x14:
-                # Selected Device Clear or Device Clear
-                self._enqueue(RemotizerDevClear())
-            elif msg_data == 0x05 and self.hpib_state == 2:
-                # PPC
-                self.sa_state = 1
-            elif msg_data == 0x15:
-                # PPU
-                # TODO:
-                pass
-            elif msg_data == 0x18:
-                # SPE
-                self.spms = True
-            elif msg_data == 0x19:
-                # SPD
-                self.spms = False
-            elif msg_data == self.mla:
-                # MLA
-                self._unlistened()
-                # -> LADS
-                self.hpib_state = 2
-                # -> LPAS
-                self.sa_state = 3
-                self.next_event = None
-                if not self.has_sa:
-                    self._set_addressed(True)
-            elif msg_data == 0x3f and self.hpib_state == 2:
-                # UNL
-                # -> idle
-                self.hpib_state = 0
-                self._unlistened()
-                self._set_addressed(False)
-            elif msg_data == self.mta:
-                # MTA
-                self._unlistened()
-                # -> TADS
-                self.hpib_state = 1
-                # -> TPAS
-                self.sa_state = 2
-                self.next_event = RemotizerTalk(None)
-                if not self.has_sa:
-                    self._set_addressed(True)
-            elif (msg_data & 0x60) == 0x40:
-                # OTA or UNT
-                if self.hpib_state == 1:
-                    self.hpib_state = 0
-                    self.next_event = None
-                    self._set_addressed(False)
-                if msg_data == 0x5f:
-                    # -> UNT
-                    self.sa_state = 4
-            elif not is_pcg:
-                # Secondary address
-                if self.sa_state == 1:
-                    # PPE / PPD
-                    # TODO:
-                    pass
-                elif self.sa_state == 2:
-                    # MTA + SA
-                    self.next_event = RemotizerTalk(msg_data & 0x1f)
-                    self._set_addressed(True)
-                elif self.sa_state == 3:
-                    # MLA + SA
-                    self.listen_sa = msg_data & 0x1f
-                    self._set_addressed(True)
-                elif self.sa_state == 4 and msg_data == self.msa:
-                    # UNT + SA
-                    self.next_event = RemotizerIdentify()
+            self.cmd_fns[ msg_data ](self , msg_data)
         elif self.hpib_state == 2:
             # DAB
-            self.accum.append(msg_data)
+            accum = self.accum
+            accum.append(msg_data)
             self.listen_data = True
-            if len(self.accum) == 256:
+            if len(accum) == 256:
                 self._flush_accum()
 
     def _fsm488_E(self , msg_data):
@@ -432,53 +508,67 @@ class RemotizerIO:
         "Y" : _fsm488_Y,
     }
 
+    # Regex matching one message or one malformed message (to be skipped) at
+    # the start of parser input. Messages look like "D:1f" and are terminated
+    # by a blank, a comma or a semicolon. Once a character is found that can't
+    # continue a message, everything up to the next terminator is skipped.
+    # Blanks are the bytes that str.isspace() accepts.
+    # Group 1: leading blanks, group 2: message type, group 3: hex data,
+    # group 4: valid prefix of malformed message
+    # Lookahead + backreference makes groups 1 & 4 atomic
+    BLANKS = rb"\t\n\x0b\x0c\r\x1c-\x20\x85\xa0"
+    TERMS = BLANKS + rb",;"
+    MSG_TYPES = "".join(MSGS).encode("ascii")
+    MSG_RE = re.compile(rb"(?=([" + BLANKS + rb"]*))\1" +
+                        rb"(?:([" + MSG_TYPES + rb"]):([0-9A-Fa-f]{2})[" + TERMS + rb"]" +
+                        rb"|(?=((?:[" + MSG_TYPES + rb"](?::[0-9A-Fa-f]{0,2})?)?))\4.[^" + TERMS + rb"]*[" + TERMS + rb"])" ,
+                        re.DOTALL)
+    # Longest incomplete message ("D:1f" without terminator)
+    MAX_MSG_LEN = 4
+    # Message type (byte value) is key
+    MSG_FNS = { ord(k) : (k , v) for k , v in MSGS.items() }
+
     def _parse_msgs(self , gen):
-        parser_state = 0
+        # Unparsed tail of input (an incomplete message)
+        buf = b""
+        match = self.MSG_RE.match
+        msg_fns = self.MSG_FNS
+        hex_bytes = HEX_BYTES
         for ins in gen:
-            for b in ins:
-                c = chr(b)
-                if parser_state == 0:
-                    msg_type = c
-                    fsm_fn = self.MSGS.get(c)
-                    if fsm_fn != None:
-                        parser_state = 1
-                    elif not c.isspace():
-                        parser_state = 5
-                elif parser_state == 1:
-                    if c == ':':
-                        parser_state = 2
-                    else:
-                        parser_state = 5
-                elif parser_state == 2:
-                    try:
-                        data = int(c , 16)
-                        parser_state = 3
-                    except ValueError:
-                        parser_state = 5
-                elif parser_state == 3:
-                    try:
-                        data = (data << 4) + int(c , 16)
-                        parser_state = 4
-                    except ValueError:
-                        parser_state = 5
-                elif parser_state == 4:
-                    if c.isspace() or c == ',' or c == ';':
-                        parser_state = 0
-                        yield msg_type , fsm_fn , data
-                    else:
-                        parser_state = 5
-                else:
-                    if c.isspace() or c == ',' or c == ';':
-                        parser_state = 0
-
+            buf = buf + ins if buf else ins
+            pos = 0
+            m = match(buf)
+            while m is not None:
+                pos = m.end()
+                msg_type = m[ 2 ]
+                if msg_type is not None:
+                    msg_type , fsm_fn = msg_fns[ msg_type[ 0 ] ]
+                    yield msg_type , fsm_fn , hex_bytes[ m[ 3 ] ]
+                m = match(buf , pos)
+            # Tail is copied as input buffer is going to be overwritten
+            buf = bytes(buf[ pos: ])
+            if len(buf) > self.MAX_MSG_LEN:
+                # Tail is not just an incomplete message: it's either leading
+                # blanks or a malformed message with no terminator yet. Keep it
+                # bounded: drop blanks and replace a malformed message with
+                # a single byte that makes parsing resume after next terminator.
+                buf = buf.lstrip(BLANK_BYTES)
+                if len(buf) > self.MAX_MSG_LEN:
+                    buf = b"\x00"
+
+    # Yields views of a buffer that is reused by next recv
     def _rem_recv(self , conn):
+        mv = memoryview(bytearray(RECV_BUF_SIZE))
+        quickack = TCP_QUICKACK is not None
         while True:
             try:
-                ins = conn.recv(4096)
-                if len(ins) == 0:
+                n = conn.recv_into(mv)
+                if n == 0:
                     break
                 else:
-                    yield ins
+                    if quickack and n < RECV_BUF_SIZE:
+                        quickack = rearm_quickack(conn)
+                    yield mv[ :n ]
             except ConnectionError:
                 break
 
@@ -498,17 +588,23 @@ class RemotizerIO:
                 try:
                     self.io = socket.socket()
                     self.io.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    # Accepted connections inherit buffer sizes, which are then
+                    # in effect from the handshake on (TCP window scaling)
+                    self.io.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUF_SIZE)
+                    self.io.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUF_SIZE)
                     self.io.bind(('0.0.0.0' , self.port))
+                    set_tcp_opt(self.io , "TCP_FASTOPEN" , TFO_QUEUE_LEN)
+                    self.io.listen(LISTEN_BACKLOG)
                     self.state = 1
                 except ConnectionError as e:
                     self.state = 3
                     self._enqueue(RemotizerConnection(CONNECTION_ERROR , str(e)))
             elif self.state == 1:
                 try:
-                    self.io.listen(1)
                     #with self.lock:
                     self.conn , addr = self.io.accept()
                     self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    set_tcp_opt(self.conn , "TCP_QUICKACK" , 1)
                     self._enqueue(RemotizerConnection(CONNECTION_OK , str(addr)))
                     self.state = 2
                     self._init_488()
@@ -516,11 +612,15 @@ class RemotizerIO:
                     self.state = 3
                     self._enqueue(RemotizerConnection(CONNECTION_ERROR , str(e)))
             elif self.state == 2:
-                for msg_type , fsm_fn , data in self._parse_msgs(self._rem_recv(self.conn)):
-                    if self.debug and self.debug_mask & DBG_IN_MSG:
+                msgs = self._parse_msgs(self._rem_recv(self.conn))
+                if self.debug and self.debug_mask & DBG_IN_MSG:
+                    for msg_type , fsm_fn , data in msgs:
                         print("{}:{:02x}<".format(msg_type , data) , file = self.debug)
                         #self._enqueue(RemotizerMsg(msg_type , data))
-                    fsm_fn(self , data)
+                        fsm_fn(self , data)
+                else:
+                    for msg_type , fsm_fn , data in msgs:
+                        fsm_fn(self , data)
                 self._conn_close()
             else:
                 return
@@ -546,8 +646,8 @@ class RemotizerIO:
         self.conn = None
         # This mutex protects the SR FSM
         self.sr_lock = threading.RLock()
-        self.cv = threading.Condition(self.lock)
-        self.q = collections.deque()
+        # Queue of events
+        self.q = queue.SimpleQueue()
         self._init_488()
         self.disable_unlisten_sa()
         self.status_byte = 0
@@ -562,9 +662,18 @@ class RemotizerIO:
             self.mta = self.hpib_addr | 0x40
             self.mla = self.hpib_addr | 0x20
             self.msa = self.hpib_addr | 0x60
+            # Handlers of command bytes
+            # Command byte (7 bits) is index
+            fns = [ RemotizerIO._cmd_nop ] * 0x40 + [ RemotizerIO._cmd_ota ] * 0x20 + [ RemotizerIO._cmd_sa ] * 0x20
+            for code , fn in RemotizerIO.FIXED_CMD_FNS.items():
+                fns[ code ] = fn
+            # MLA & MTA take precedence over UNL & UNT
+            fns[ self.mla ] = RemotizerIO._cmd_mla
+            fns[ self.mta ] = RemotizerIO._cmd_mta
+            self.cmd_fns = fns
 
     def has_events(self):
-        return len(self.q) > 0
+        return not self.q.empty()
 
     # Events that are returned by this function:
     # RemotizerConnection   Status of remotizer connection
@@ -578,16 +687,12 @@ class RemotizerIO:
     # RemotizerSerialPoll   Serial poll received
     # RemotizerSPAS         SPAS state on/off
     def get_event(self , timeout = None):
-        with self.cv:
-            if self.cv.wait_for(lambda : self.has_events() , timeout):
-                return self.q.popleft()
-            else:
-                return None
+        try:
+            return self.q.get(timeout = timeout)
+        except queue.Empty:
+            return None
 
-    def send_msg(self, msg_type , msg_data):
-        b = bytes("{}:{:02x},".format(msg_type , msg_data) , encoding = "ascii")
-        if self.debug and self.debug_mask & DBG_OUT_MSG:
-            print("{}:{:02x}>".format(msg_type , msg_data) , file = self.debug)
+    def _send_bytes(self , b):
         try:
             with self.lock:
                 if self.conn:
@@ -597,16 +702,28 @@ class RemotizerIO:
         except OSError:
             pass
 
+    def send_msg(self, msg_type , msg_data):
+        b = bytes("{}:{:02x},".format(msg_type , msg_data) , encoding = "ascii")
+        if self.debug and self.debug_mask & DBG_OUT_MSG:
+            print("{}:{:02x}>".format(msg_type , msg_data) , file = self.debug)
+        self._send_bytes(b)
+
     def talk_data(self, data , eoi_at_end = False):
         last_dab = len(data)
         add_eoi = eoi_at_end and last_dab > 0
         if add_eoi:
             last_dab -= 1
-        with self.lock:
-            for b in data[ :last_dab ]:
-                self.send_msg('D' , b)
+        dabs = data[ :last_dab ]
+        # All messages are sent at once
+        out = b"".join(map(DAB_MSGS.__getitem__ , dabs))
+        if add_eoi:
+            out += END_MSGS[ data[ last_dab ] ]
+        if self.debug and self.debug_mask & DBG_OUT_MSG:
+            for b in dabs:
+                print("D:{:02x}>".format(b) , file = self.debug)
             if add_eoi:
-                self.send_msg('E' , data[ last_dab ])
+                print("E:{:02x}>".format(data[ last_dab ]) , file = self.debug)
+        self._send_bytes(out)
 
     def set_pp_response(self , pp_mask):
         self.pp_mask = pp_mask
@@ -631,6 +748,10 @@ class RemotizerIO:
     def set_status_byte(self , b):
         self.status_byte = b & 0xbf
 
+    # Make a pending get_event return None
+    def wake_up(self):
+        self.q.put(None)
+
     def force_data(self , data):
         self._enqueue(RemotizerData(None, data, False, False))
 
@@ -0,0 +1,53 @@
+# Short sectors received by the Amigo emulators are padded with zeros
+import os
+import sys
+import types
+
+import pytest
+
+HP_DIR = os.path.join(os.path.dirname(__file__) , os.pardir , "hp")
+sys.path.insert(0 , HP_DIR)
+sys.path.insert(0 , os.path.join(HP_DIR , "hp_disk"))
+
+OLD_SECTOR = bytes(range(256))
+SHORT_DATA = b"\xaa" * 10
+PADDED = SHORT_DATA + bytes(256 - len(SHORT_DATA))
+
+class FakeIO:
+    def __getattr__(self , name):
+        return lambda *args: None
+
+def make_image(tmp_path , n_sectors):
+    path = tmp_path / "disk.img"
+    path.write_bytes(OLD_SECTOR * n_sectors)
+    return path
+
+def test_amigo_drive_pads_short_sector(tmp_path):
+    import amigo_drive
+    fixed = amigo_drive.FixedDriveData("9895")
+    path = make_image(tmp_path , fixed.max_lba)
+    state = amigo_drive.DriveState(FakeIO() , fixed , 0 , [ open(path , "r+b") ])
+    # Leave previous sector in drive buffer
+    state.units[ 0 ].read_img(state.buffer_)
+    state.units[ 0 ].current_lba = 1
+    state.set_seq_state(3)
+    state.cmd_rx_data(types.SimpleNamespace(params = SHORT_DATA))
+    for unit in state.units:
+        unit.close()
+    assert path.read_bytes()[ 256:512 ] == PADDED
+
+def test_hp_disk_pads_short_sector(tmp_path):
+    pytest.importorskip("PyQt6")
+    import hp_disk_protocol
+    model = hp_disk_protocol.DRIVE_MODELS[ 0 ]
+    state = hp_disk_protocol.AmigoDriveState(FakeIO() , model)
+    unit = state.units[ 0 ]
+    path = make_image(tmp_path , unit.geometry.max_lba)
+    assert unit.load_image(str(path)) == 0
+    # Leave previous sector in drive buffer
+    state.buffer_[ : ] = unit.read_img()
+    unit.current_lba = 1
+    state.set_seq_state(3)
+    state.cmd_rx_data(types.SimpleNamespace(data = bytearray(SHORT_DATA)))
+    unit.unload_image()
+    assert path.read_bytes()[ 256:512 ] == PADDED